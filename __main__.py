@@ -1,10 +1,46 @@
-import os, sys
+import os, sys, argparse
 
 sys.path.append(os.path.join(os.getcwd(), 'src'))
 from dotenv import load_dotenv
 
-from src.data_processing import process_data
+import config
+from src.commons import STAGES, write_run_report
+from src.data_processing import process_data, process_delta
+from src.modeling.prediction_server import run_server
 load_dotenv()
 
 if __name__=='__main__':
-    process_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='La Guajira salinity data processing pipeline.')
+    parser.add_argument('--rerun-from', choices=STAGES, default=None,
+                        help='run this stage and every stage after it again, ignoring their cached results')
+    parser.add_argument('--no-cache', action='store_true', help='run every stage without reading or writing the stage cache')
+    parser.add_argument('--skip-profiling', nargs='*', choices=list(config.profiling['stages']), default=[],
+                        help='pipeline stages whose profiling report is not generated')
+    parser.add_argument('--no-instrumentation', action='store_true', help='do not record the run report of the stages')
+    parser.add_argument('--profile-stage', default=None, metavar='STAGE',
+                        help='run this stage (e.g. input_numeric_cols) under cProfile and dump its stats next to the run report')
+    parser.add_argument('--delta', action='store_true',
+                        help='update the curated dataset with the new, changed and removed source records instead of rebuilding it')
+    parser.add_argument('--refit-terciles', action='store_true', help='refit the tercile thresholds of --delta whatever the refit policy')
+    parser.add_argument('--serve', action='store_true', help='run the local prediction server instead of the pipeline')
+    parser.add_argument('--model', default=None, help='model of the registry served with --serve, by default config.server["model"]')
+    parser.add_argument('--port', type=int, default=None, help='port of the prediction server, by default config.server["port"]')
+    args = parser.parse_args()
+    if args.serve:
+        run_server(model_name=args.model, port=args.port)
+    else:
+        if args.no_instrumentation:
+            config.instrumentation['enabled'] = False
+        if args.profile_stage:
+            config.instrumentation['profile_stage'] = args.profile_stage
+        if args.no_cache:
+            config.cache['enabled'] = False
+        for stage in args.skip_profiling:
+            config.profiling['stages'][stage] = False
+        if args.delta:
+            report = process_delta(refit_terciles=args.refit_terciles)
+            print(', '.join(f'{name}: {value}' for name, value in report.items()))
+            write_run_report('process_delta')
+        else:
+            process_data(rerun_from=args.rerun_from)
+            write_run_report('process_data')
\ No newline at end of file
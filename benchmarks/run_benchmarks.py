@@ -0,0 +1,185 @@
+import os, sys, json, glob, time, argparse, platform, subprocess, tempfile, tracemalloc
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'src'))
+import pandas as pd, numpy as np
+from imblearn.pipeline import Pipeline
+from imblearn.over_sampling import SMOTE
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import MinMaxScaler, OneHotEncoder, LabelEncoder
+
+import config
+from config import models_args, search_spaces
+from data_processing.salinity_process import select_salinity_cols, input_numeric_cols, join_gepandas, get_salt_categories
+from modeling.cross_validation import cross_validate
+from modeling.search import make_estimator
+from commons import load_spatial_index
+from synthetic import salinity_table, write_inputs
+
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def measure(function, repeat: int, memory: bool) -> tuple:
+    """Run a benchmark repeatedly and measure it.
+    Wall times are taken without tracing. The peak memory is taken from an additional run under
+    tracemalloc, which follows the Python and numpy allocations of the current process.
+
+    Args:
+        function: Callable without arguments that runs the benchmark once.
+        repeat (int): Number of timed runs.
+        memory (bool): Whether to measure the peak memory.
+
+    Returns:
+        tuple: The result of the last run, the wall time of each run in seconds and the peak memory in MB, None if not measured.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]/2**20
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def classifier_pipeline(model: str) -> Pipeline:
+    """Pipeline of the notebook for a model of `config.models_args`, built from its search space estimator."""
+    preprocess = ColumnTransformer([
+        ('num', MinMaxScaler(), ['X', 'Y']),
+        ('cat', OneHotEncoder(handle_unknown='ignore'), ['class_hidr']),
+    ])
+    clf = make_estimator(getattr(search_spaces, model)['estimator'], getattr(models_args, model))
+    return Pipeline([('prep', preprocess), ('smote_resampling', SMOTE(random_state=42)), ('clf', clf)])
+
+def run_size(n_wells: int, args: argparse.Namespace) -> list:
+    """Run every benchmark on a synthetic salinity table of the given size, each stage on the output of the previous one."""
+    raw = salinity_table(n_wells, seed=args.seed)
+    results = []
+
+    def record(name: str, function, rows_in: int, rows_out=len):
+        result, seconds, peak = measure(function, args.repeat, not args.no_memory)
+        results.append({
+            'benchmark': name, 'n_wells': n_wells, 'rows_in': rows_in, 'rows_out': rows_out(result),
+            'seconds': float(np.median(seconds)), 'runs': seconds, 'peak_memory_mb': peak
+        })
+        print(f'{n_wells:>9} {name:<22} {results[-1]["seconds"]:>10.3f}s' + (f' {peak:>10.1f}MB' if peak is not None else ''))
+        return result
+
+    precurated = record('select_salinity_cols', lambda: select_salinity_cols(raw), len(raw))
+    numeric = record('input_numeric_cols', lambda: input_numeric_cols(precurated), len(precurated))
+    dataset = numeric.copy()
+    dataset[config.salinity_cat_cols] = precurated[config.salinity_cat_cols]
+    load_spatial_index()
+    joined = record('join_gepandas', lambda: join_gepandas(dataset[['X', 'Y']]), len(dataset))
+    dataset['class_hidr'] = joined['class_hidr']
+    dataset = dataset.dropna(subset=['class_hidr'])
+    curated = record('get_salt_categories', lambda: get_salt_categories(dataset.copy()), len(dataset))
+    curated = curated.dropna(subset=['CATEGORIA_SAL'])
+    X, y = curated[['X', 'Y', 'class_hidr']], pd.Series(LabelEncoder().fit_transform(curated['CATEGORIA_SAL']))
+    _, _, model = record('cross_validate', lambda: cross_validate(classifier_pipeline(args.model), X, y, folds=args.folds, n_jobs=args.n_jobs),
+                          len(X), rows_out=lambda result: len(X))
+    record('predict_proba', lambda: model.predict_proba(X), len(X))
+    return results
+
+def latest_results() -> str:
+    """Path of the most recent results file, None when there is none."""
+    files = sorted(glob.glob(os.path.join(RESULTS, 'benchmark-*.json')))
+    return files[-1] if files else None
+
+def compare(results: list, baseline: list, tolerance: float, min_seconds: float) -> list:
+    """Flag the benchmarks that got slower or used more memory than in a baseline run.
+
+    Args:
+        results (list): Results of the current run.
+        baseline (list): Results of the baseline run, matched by benchmark and number of wells.
+        tolerance (float): Relative increase over the baseline that is flagged, e.g. 0.2 for 20%.
+        min_seconds (float): Time increases below this many seconds are taken as noise.
+
+    Returns:
+        list: The regressions, with the metric, its baseline and current value and their ratio.
+    """
+    previous = {(item['benchmark'], item['n_wells']): item for item in baseline}
+    regressions = []
+    for item in results:
+        before = previous.get((item['benchmark'], item['n_wells']))
+        if before is None:
+            continue
+        for metric, noise in (('seconds', min_seconds), ('peak_memory_mb', 0)):
+            old, new = before.get(metric), item.get(metric)
+            if old is None or new is None or new - old <= noise:
+                continue
+            if new > old*(1 + tolerance):
+                regressions.append({
+                    'benchmark': item['benchmark'], 'n_wells': item['n_wells'], 'metric': metric,
+                    'baseline': old, 'current': new, 'ratio': new/old if old else float('inf')
+                })
+    return regressions
+
+def environment() -> dict:
+    """Machine, interpreter, library versions and commit of the run, to compare like with like."""
+    import sklearn, shapely, geopandas
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+        'cpu_count': os.cpu_count(), 'commit': commit or None,
+        'packages': {module.__name__: module.__version__ for module in (np, pd, sklearn, shapely, geopandas)}
+    }
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the salinity pipeline stages and models on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000],
+                        help='numbers of synthetic wells, from 1000 up to 1000000')
+    parser.add_argument('--polygons', type=int, default=1_000, help='polygons of the synthetic hydrogeologic map')
+    parser.add_argument('--model', default='DecisionTree', choices=[name for name in vars(models_args) if not name.startswith('_')],
+                        help='model of config.models_args used by cross_validate and predict_proba')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--n-jobs', type=int, default=1, help='worker processes of cross_validate, memory is only measured in the main process')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs of each benchmark, the median is reported')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run that measures the peak memory')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--baseline', default=None, help='results file to compare with, by default the latest one')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative increase flagged as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='time increases below this are taken as noise')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 when a regression is flagged')
+    args = parser.parse_args()
+
+    #stages run on their inputs every time, in a scratch working directory
+    config.cache['enabled'] = False
+    baseline_file = args.baseline or latest_results()
+    results, cwd = [], os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for directory in config.path.values():
+                os.makedirs(directory, exist_ok=True)
+            write_inputs(args.polygons, seed=args.seed)
+            for n_wells in args.sizes:
+                results.extend(run_size(n_wells, args))
+        finally:
+            os.chdir(cwd)
+
+    regressions = []
+    if baseline_file:
+        with open(baseline_file) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance, args.min_seconds)
+        for item in regressions:
+            print(f'REGRESSION {item["benchmark"]} ({item["n_wells"]} wells) {item["metric"]}: '
+                  f'{item["baseline"]:.3f} -> {item["current"]:.3f} (x{item["ratio"]:.2f})')
+    os.makedirs(RESULTS, exist_ok=True)
+    created_at = datetime.now(timezone.utc)
+    output = os.path.join(RESULTS, f'benchmark-{created_at:%Y%m%dT%H%M%S}.json')
+    with open(output, 'w') as f:
+        json.dump({
+            'created_at': created_at.isoformat(timespec='seconds'), 'environment': environment(),
+            'settings': vars(args), 'baseline': baseline_file, 'results': results, 'regressions': regressions
+        }, f, indent=2)
+    print(f'Results written to {output}')
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,102 @@
+import os, glob, zipfile, tempfile
+import pandas as pd, numpy as np
+import geopandas as gpd, shapely
+
+import config
+
+#extent of the La Guajira hydrogeologic map in its coordinate system
+BBOX = (1_044_870.0, 1_641_374.0, 1_322_742.0, 1_870_513.0)
+CRS = 'EPSG:21897'
+CLASSES = ['A2', 'A3', 'A4', 'B2', 'B3', 'B4', 'C1', 'C2']
+SITE_TYPES = ['Pozo', 'Pozo', 'Pozo', 'Aljibe', 'Manantial']
+
+
+def _messy_numbers(values: np.ndarray, rng: np.random.Generator, messy_share: float, missing_share: float) -> np.ndarray:
+    """Write numbers the way the source spreadsheet does: comma decimals, units, stray signs and blanks."""
+    text = np.array([f'{value:.2f}' for value in values], dtype=object)
+    kind = rng.choice(5, len(values), p=[1 - messy_share] + [messy_share/4]*4)
+    text[kind==1] = np.char.replace(text[kind==1].astype(str), '.', ',')
+    text[kind==2] = np.char.add(text[kind==2].astype(str), ' mg/L')
+    text[kind==3] = np.char.add('-', text[kind==3].astype(str))
+    text[kind==4] = np.char.add(' ', text[kind==4].astype(str))
+    missing = rng.random(len(values)) < missing_share
+    text[missing] = rng.choice(np.array(['', ' ', '  ', None], dtype=object), missing.sum())
+    return text
+
+def salinity_table(n_wells: int, seed: int=42, messy_share: float=0.1, missing_share: float=0.05) -> pd.DataFrame:
+    """Generate a raw salinity table with the columns of `config.salinity_data_dictionary`.
+    Coordinates fall inside `BBOX`, except for a small share outside the map. Numeric columns are
+    text with comma decimals, units, signs, padding and blank sentinels, text columns mix the
+    land use aliases with blank values, like the published dataset.
+
+    Args:
+        n_wells (int): Number of records.
+        seed (int): Seed of the generator.
+        messy_share (float): Share of the numeric values written with a messy format.
+        missing_share (float): Share of missing or blank values in the columns that may be empty.
+
+    Returns:
+        pd.DataFrame: The raw salinity table.
+    """
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = BBOX
+    margin = 0.02*(xmax - xmin)
+    x = rng.uniform(xmin - margin, xmax + margin, n_wells)
+    y = rng.uniform(ymin, ymax, n_wells)
+    salinity = rng.gamma(1.5, 2.0, n_wells) + 0.002*(x - xmin)/1000
+    cond = salinity*1800*rng.lognormal(0, 0.1, n_wells)
+    uses = [alias for aliases in config.salinity_group_use_aliases.values() for alias in aliases]
+    table = dict()
+    for col, typ in config.salinity_data_dictionary.items():
+        if typ == int:
+            table[col] = np.arange(1, n_wells + 1) if col in ('OBJECTID', 'ID_TOTAL', 'No_Consecu') else rng.integers(1, 60, n_wells)
+        elif typ == float:
+            table[col] = _messy_numbers(rng.gamma(2.0, 50.0, n_wells), rng, messy_share, missing_share)
+        else:
+            table[col] = rng.choice(np.array(['A', 'B', 'C', ' ', None], dtype=object), n_wells)
+    table.update({
+        'X': _messy_numbers(x, rng, messy_share/2, 0), 'Y': _messy_numbers(y, rng, messy_share/2, 0),
+        'SAL': _messy_numbers(salinity, rng, messy_share, missing_share),
+        'Sal_seco': _messy_numbers(salinity*rng.lognormal(0, 0.05, n_wells), rng, messy_share, missing_share),
+        'Cond_Seco': _messy_numbers(cond, rng, messy_share, missing_share),
+        'CE': _messy_numbers(cond/1000, rng, messy_share, missing_share),
+        'STD_seco': _messy_numbers(cond*0.64, rng, messy_share, missing_share),
+        'pH_seco': _messy_numbers(rng.normal(7.5, 0.6, n_wells), rng, messy_share, missing_share),
+        'T_Seco': _messy_numbers(rng.normal(29, 2, n_wells), rng, messy_share, missing_share),
+        'Tipo_de_Ca': rng.choice(np.array(SITE_TYPES + [' '], dtype=object), n_wells),
+        'Uso_del_Su': rng.choice(np.array(uses + ['', ' ', None], dtype=object), n_wells)
+    })
+    return pd.DataFrame(table)
+
+def hydrogeology_polygons(n_polygons: int, seed: int=42) -> gpd.GeoDataFrame:
+    """Generate a hydrogeologic map of Voronoi polygons that tile `BBOX`, each with a `class_hidr`."""
+    rng = np.random.default_rng(seed)
+    xmin, ymin, xmax, ymax = BBOX
+    seeds = shapely.multipoints(np.column_stack([rng.uniform(xmin, xmax, n_polygons), rng.uniform(ymin, ymax, n_polygons)]))
+    extent = shapely.box(*BBOX)
+    cells = shapely.intersection(shapely.get_parts(shapely.voronoi_polygons(seeds, extend_to=extent)), extent)
+    return gpd.GeoDataFrame({'class_hidr': rng.choice(CLASSES, len(cells))}, geometry=cells, crs=CRS)
+
+def _write_zipped_shapefile(layer: gpd.GeoDataFrame, file_path: str) -> None:
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    with tempfile.TemporaryDirectory() as directory:
+        layer.to_file(os.path.join(directory, f'{name}.shp'))
+        with zipfile.ZipFile(file_path, 'w') as archive:
+            for part in glob.glob(os.path.join(directory, '*')):
+                archive.write(part, os.path.basename(part))
+
+def write_inputs(n_polygons: int, seed: int=42) -> None:
+    """Write the synthetic polygon map and the salinity points layer to the raw data directory.
+    The salinity layer only provides the CRS of the coordinates, so a single point is written.
+
+    Args:
+        n_polygons (int): Number of polygons of the map.
+        seed (int): Seed of the generator.
+
+    Returns:
+        None
+    """
+    os.makedirs(config.path['raw_data'], exist_ok=True)
+    _write_zipped_shapefile(hydrogeology_polygons(n_polygons, seed), os.path.join(config.path['raw_data'], 'Mapa_hidrogeologico_polygon.zip'))
+    points = gpd.GeoDataFrame({'OBJECTID': [1]}, geometry=[shapely.box(*BBOX).centroid], crs=CRS)
+    _write_zipped_shapefile(points, os.path.join(config.path['raw_data'], '_Salinidad_Guajira.zip'))
@@ -1 +1,5 @@
-from commons.tool_box import check_directories, profile_dataset
\ No newline at end of file
+from commons.tool_box import check_directories, profile_dataset, wait_for_profiles
+from commons.artifacts import read_artifact, write_artifact
+from commons.spatial_index import load_spatial_index, lookup_class_hidr, salinity_crs
+from commons.stage_cache import STAGES, cached_stage, force_rerun, fingerprint, file_fingerprint
+from commons.instrumentation import trace, traced, record_span, snapshot, elapsed, peak_rss_mb, write_run_report
\ No newline at end of file
@@ -0,0 +1,82 @@
+import os
+import config
+
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa, pyarrow.parquet as pq
+
+
+def artifact_path(name: str, directory: str, fmt: str=None) -> str:
+    """Build the file path of a pipeline artifact.
+
+    Args:
+        name (str): Artifact name, without extension.
+        directory (str): Directory where the artifact is stored, usually one of `config.path`.
+        fmt (str): Storage format, 'parquet' or 'csv'. By default `config.artifacts['format']`.
+
+    Returns:
+        str: The artifact file path.
+    """
+    return os.path.join(directory, f"{name}.{fmt or config.artifacts['format']}")
+
+def _arrow_ready(dataset: pd.DataFrame) -> pd.DataFrame:
+    """Write the values of object columns that mix strings with other types as strings, so Arrow can type them."""
+    mixed = [
+        col for col in dataset.columns[dataset.dtypes==object]
+        if pd.api.types.infer_dtype(dataset[col], skipna=True).startswith('mixed')
+    ]
+    if not mixed:
+        return dataset
+    return dataset.assign(**{col: dataset[col].map(lambda value: value if pd.isna(value) else str(value)) for col in mixed})
+
+def write_artifact(dataset: pd.DataFrame, name: str, directory: str, fmt: str=None, export_csv: bool=None) -> str:
+    """Save a pipeline artifact.
+    Parquet artifacts keep the column dtypes, with categorical columns stored dictionary encoded, and
+    GeoDataFrames are stored as GeoParquet. The index is not stored, as in the CSV exports.
+
+    Args:
+        dataset (pd.DataFrame): Dataset to save.
+        name (str): Artifact name, without extension.
+        directory (str): Directory where the artifact is stored, usually one of `config.path`.
+        fmt (str): Storage format, 'parquet' or 'csv'. By default `config.artifacts['format']`.
+        export_csv (bool): Whether to also export a CSV copy next to a Parquet artifact.
+            By default `config.artifacts['export_csv']`.
+
+    Returns:
+        str: The path of the saved artifact.
+    """
+    fmt = fmt or config.artifacts['format']
+    export_csv = config.artifacts['export_csv'] if export_csv is None else export_csv
+    file_path = artifact_path(name, directory, fmt)
+    if fmt=='csv':
+        dataset.to_csv(file_path, index=0)
+        return file_path
+    if isinstance(dataset, gpd.GeoDataFrame):
+        dataset.to_parquet(file_path, index=False, compression=config.artifacts['compression'])
+    else:
+        table = pa.Table.from_pandas(_arrow_ready(dataset), preserve_index=False)
+        pq.write_table(table, file_path, compression=config.artifacts['compression'], use_dictionary=True)
+    if export_csv:
+        dataset.to_csv(artifact_path(name, directory, 'csv'), index=0)
+    return file_path
+
+def read_artifact(name: str, directory: str, columns: list=None, memory_map: bool=True, fmt: str=None) -> pd.DataFrame:
+    """Load a pipeline artifact.
+
+    Args:
+        name (str): Artifact name, without extension.
+        directory (str): Directory where the artifact is stored, usually one of `config.path`.
+        columns (list): Columns to read, by default all of them. Parquet artifacts only read these columns from disk.
+        memory_map (bool): Whether to memory-map Parquet files instead of reading them into a buffer.
+        fmt (str): Storage format, 'parquet' or 'csv'. By default `config.artifacts['format']`.
+
+    Returns:
+        pd.DataFrame: The artifact, a GeoDataFrame for GeoParquet files.
+    """
+    fmt = fmt or config.artifacts['format']
+    file_path = artifact_path(name, directory, fmt)
+    if fmt=='csv':
+        return pd.read_csv(file_path, usecols=columns)
+    if b'geo' in (pq.read_schema(file_path, memory_map=memory_map).metadata or {}):
+        return gpd.read_parquet(file_path, columns=columns)
+    return pq.read_table(file_path, columns=columns, memory_map=memory_map).to_pandas()
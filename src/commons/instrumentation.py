@@ -0,0 +1,151 @@
+import os, sys, json, time, platform, cProfile
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from functools import wraps
+import config
+
+import pandas as pd, numpy as np
+try:
+    import resource
+except ImportError:
+    #peak RSS is not available on Windows
+    resource = None
+
+#spans of the current run, in the order they finish, and names of the open spans
+_run = {'spans': [], 'stack': [], 'started_at': None, 'clock': None}
+
+
+def _enabled() -> bool:
+    return config.instrumentation['enabled']
+
+def snapshot() -> tuple:
+    """Current wall clock and CPU time of the process, to measure a step with `elapsed`."""
+    return time.perf_counter(), time.process_time()
+
+def elapsed(start: tuple) -> dict:
+    """Wall and CPU seconds since a `snapshot`."""
+    wall, cpu = snapshot()
+    return {'wall_seconds': wall - start[0], 'cpu_seconds': cpu - start[1]}
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MB, None where it is not available."""
+    if resource is None:
+        return None
+    #ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/(2**20 if sys.platform=='darwin' else 2**10)
+
+def _children_cpu() -> float:
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def count_rows(value) -> int:
+    """Number of rows of a data frame, series or array, or of the first item of a tuple, None otherwise."""
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)) else None
+
+def record_span(name: str, **fields) -> None:
+    """Add a span measured elsewhere, e.g. in a worker process, to the run report.
+    Args:
+        name (str): Name of the span.
+        **fields: Measurements of the span.
+    Returns:
+        None
+    """
+    if not _enabled():
+        return
+    if _run['clock'] is None:
+        start_run()
+    _run['spans'].append({'name': name, 'parent': _run['stack'][-1] if _run['stack'] else None} | fields)
+
+def _profile_file(name: str) -> str:
+    return os.path.join(config.path['run_reports'], f'{name}-{_run["started_at"]:%Y%m%dT%H%M%S}.prof')
+
+@contextmanager
+def _trace(name: str, rows_in: int):
+    if _run['clock'] is None:
+        start_run()
+    span = {'name': name, 'parent': _run['stack'][-1] if _run['stack'] else None,
+            'offset_seconds': time.perf_counter() - _run['clock'], 'rows_in': rows_in, 'rows_out': None}
+    profiler = cProfile.Profile() if config.instrumentation['profile_stage']==name else None
+    _run['stack'].append(name)
+    rss, children_cpu, start = peak_rss_mb(), _children_cpu(), snapshot()
+    if profiler:
+        profiler.enable()
+    try:
+        yield span
+    finally:
+        if profiler:
+            profiler.disable()
+            span['profile'] = _profile_file(name)
+            os.makedirs(config.path['run_reports'], exist_ok=True)
+            profiler.dump_stats(span['profile'])
+        span.update(elapsed(start))
+        span['children_cpu_seconds'] = _children_cpu() - children_cpu
+        span['peak_rss_mb'] = peak_rss_mb()
+        span['rss_growth_mb'] = span['peak_rss_mb'] - rss if rss is not None else None
+        _run['stack'].pop()
+        _run['spans'].append(span)
+
+def trace(name: str, rows_in: int=None):
+    """Measure a block of code as a span of the run report.
+    The span records the wall and CPU time of the process, the CPU time of the worker processes
+    that finished within it, the peak RSS and the rows in and out, which the block can set on the
+    yielded span. When `config.instrumentation['profile_stage']` is the span name, the block is also
+    run under cProfile and the stats are dumped next to the run reports. When instrumentation is
+    disabled it returns a no-op context.
+
+    Args:
+        name (str): Name of the span.
+        rows_in (int): Number of rows the block receives.
+
+    Returns:
+        The context manager, which yields the span dict or None when disabled.
+    """
+    if not _enabled():
+        return nullcontext()
+    return _trace(name, rows_in)
+
+def traced(func):
+    """Decorator that measures every call of a function as a span named after it.
+    Rows in are counted on the first data frame, series or array argument and rows out on the result.
+    When instrumentation is disabled the function is called directly.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled():
+            return func(*args, **kwargs)
+        rows_in = next((rows for rows in map(count_rows, list(args) + list(kwargs.values())) if rows is not None), None)
+        with _trace(func.__name__, rows_in) as span:
+            result = func(*args, **kwargs)
+            span['rows_out'] = count_rows(result)
+            return result
+    return wrapper
+
+def start_run() -> None:
+    """Start a new run report, discarding the spans that were not written."""
+    _run.update(spans=[], stack=[], started_at=datetime.now(timezone.utc), clock=time.perf_counter())
+
+def write_run_report(name: str) -> str:
+    """Write the spans recorded since the run started as a JSON run report and start a new run.
+    Args:
+        name (str): Name of the run, e.g. 'process_data'.
+    Returns:
+        str: Path of the report, None when instrumentation is disabled or nothing was recorded.
+    """
+    if not _enabled() or not _run['spans']:
+        return None
+    os.makedirs(config.path['run_reports'], exist_ok=True)
+    report = {
+        'run': name, 'started_at': _run['started_at'].isoformat(timespec='seconds'),
+        'wall_seconds': time.perf_counter() - _run['clock'], 'peak_rss_mb': peak_rss_mb(),
+        'argv': sys.argv, 'pid': os.getpid(), 'python': platform.python_version(), 'platform': platform.platform(),
+        'cpu_count': os.cpu_count(), 'spans': _run['spans']
+    }
+    file_path = os.path.join(config.path['run_reports'], f'{name}-{_run["started_at"]:%Y%m%dT%H%M%S}.json')
+    with open(file_path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    start_run()
+    return file_path
@@ -0,0 +1,99 @@
+import os
+from functools import lru_cache
+import config
+
+import numpy as np
+import geopandas as gpd, shapely
+from pyproj import CRS, Transformer
+
+#loaded index shared by every lookup in the process
+_index = {}
+
+
+def hidrogeology_file() -> str:
+    """Path of the hydrogeologic polygon map in the raw data directory."""
+    return os.path.join(config.path['raw_data'], 'Mapa_hidrogeologico_polygon.zip')
+
+def index_file() -> str:
+    """Path of the persisted hydrogeologic spatial index."""
+    return os.path.join(config.path['curated_data'], 'hidrogeology_index.npz')
+
+def salinity_crs() -> CRS:
+    """Read the coordinate reference system of the salinity points layer.
+    The X, Y columns of the salinity dataset, and therefore the model features, are expressed
+    in this system. Only the layer header is read.
+
+    Returns:
+        pyproj.CRS: The coordinate reference system of `_Salinidad_Guajira.zip`.
+    """
+    return gpd.read_file(os.path.join(config.path['raw_data'], '_Salinidad_Guajira.zip'), rows=0).crs
+
+def build_spatial_index() -> dict:
+    """Build the hydrogeologic spatial index from the polygon map and persist it.
+    The polygons are stored as a single WKB buffer with its offsets, next to their `class_hidr`
+    and the map CRS, in an uncompressed `.npz` file that loads without parsing the shapefile.
+
+    Returns:
+        dict: The loaded index with the polygon 'geometry', its 'class_hidr', the 'crs' and the STRtree 'tree'.
+    """
+    hidrogeology = gpd.read_file(hidrogeology_file())
+    hidrogeology = hidrogeology[['class_hidr', 'geometry']].dropna(subset=['geometry'])
+    wkb = shapely.to_wkb(hidrogeology.geometry.values)
+    offsets = np.cumsum([0] + [len(geom) for geom in wkb])
+    np.savez(
+        index_file(),
+        wkb=np.frombuffer(b''.join(wkb), dtype=np.uint8), offsets=offsets,
+        class_hidr=hidrogeology['class_hidr'].to_numpy(dtype=str), crs=hidrogeology.crs.to_wkt()
+    )
+    return load_spatial_index(reload=True)
+
+def load_spatial_index(reload: bool=False) -> dict:
+    """Load the hydrogeologic spatial index, building it when it is missing or older than the polygon map.
+    The index is kept in memory, so the file is only read once per process.
+
+    Args:
+        reload (bool): Whether to read the persisted index again even if it is already loaded.
+
+    Returns:
+        dict: The index with the polygon 'geometry', its 'class_hidr', the 'crs' and the STRtree 'tree'.
+    """
+    if _index and not reload:
+        return _index
+    file = index_file()
+    if not os.path.exists(file) or os.path.getmtime(file) < os.path.getmtime(hidrogeology_file()):
+        return build_spatial_index()
+    with np.load(file) as data:
+        wkb, offsets = data['wkb'].tobytes(), data['offsets']
+        geometry = shapely.from_wkb([wkb[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])])
+        shapely.prepare(geometry)
+        _index.update(
+            geometry=geometry, class_hidr=data['class_hidr'].astype(object),
+            crs=CRS.from_wkt(str(data['crs'])), tree=shapely.STRtree(geometry)
+        )
+    return _index
+
+@lru_cache(maxsize=8)
+def _transformer(source: CRS, target: CRS) -> Transformer:
+    return Transformer.from_crs(source, target, always_xy=True)
+
+def lookup_class_hidr(xs, ys, crs=None) -> np.ndarray:
+    """Find the hydrogeologic class of the polygon that contains each point.
+
+    Args:
+        xs: Array-like with the X coordinates of the points.
+        ys: Array-like with the Y coordinates of the points.
+        crs: Coordinate reference system of the points, by default the one of the polygon map.
+
+    Returns:
+        np.ndarray: Object array with the `class_hidr` of each point, NaN for points outside the map.
+    """
+    index = load_spatial_index()
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    if crs is not None and not CRS.from_user_input(crs).equals(index['crs']):
+        xs, ys = _transformer(CRS.from_user_input(crs), index['crs']).transform(xs, ys)
+    points, polygons = index['tree'].query(shapely.points(xs, ys), predicate='within')
+    #keeping the first polygon for points that fall in overlapping polygons
+    points, first = np.unique(points, return_index=True)
+    class_hidr = np.full(len(xs), np.nan, dtype=object)
+    class_hidr[points] = index['class_hidr'][polygons[first]]
+    return class_hidr
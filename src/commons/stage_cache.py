@@ -0,0 +1,110 @@
+import os, time, glob, pickle, hashlib
+from functools import wraps
+import config
+
+import pandas as pd, numpy as np
+
+#pipeline stages in execution order, forcing a stage also forces the ones after it
+STAGES = ['get_salinity', 'select_salinity_cols', 'input_numeric_cols', 'join_gepandas', 'get_salt_categories']
+_forced = set()
+
+
+def force_rerun(stage: str) -> None:
+    """Force a stage and every stage downstream of it to run again, ignoring their cached results.
+
+    Args:
+        stage (str): Name of the first stage to run again, one of `STAGES`.
+
+    Returns:
+        None
+    """
+    if stage not in STAGES:
+        raise ValueError(f'Unknown stage {stage}, expected one of {STAGES}')
+    _forced.update(STAGES[STAGES.index(stage):])
+
+def _update_hash(digest, value) -> None:
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        frame = value.to_frame() if isinstance(value, pd.Series) else value
+        digest.update(repr([(str(col), str(dtype)) for col, dtype in frame.dtypes.items()]).encode())
+        digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes() if value.dtype!=object else repr(value.tolist()).encode())
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _update_hash(digest, key)
+            _update_hash(digest, item)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _update_hash(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+def fingerprint(*values) -> str:
+    """Compute a content hash of data frames, arrays, containers and plain values.
+
+    Args:
+        *values: Values to hash, data frames are hashed by their columns, dtypes, index and content.
+
+    Returns:
+        str: Hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    for value in values:
+        _update_hash(digest, value)
+    return digest.hexdigest()
+
+def file_fingerprint(file_path: str) -> str:
+    """Compute the SHA-256 digest of a file content, 'missing' when it does not exist."""
+    if not os.path.exists(file_path):
+        return 'missing'
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cached_stage(config_values=None, files=None, max_age: float=None):
+    """Memoize a pipeline stage on a hash of its inputs and the configuration it depends on.
+    The key combines the stage name, the content of its arguments, the configuration values and the
+    content of the input files. Results are pickled in the cache directory, keeping only the latest
+    entry of each stage. When the output of a stage changes, the inputs of the stages that consume it
+    change too, so their keys invalidate on their own.
+
+    Args:
+        config_values: Callable returning the configuration values the stage depends on.
+        files: Callable returning the paths of the files the stage reads.
+        max_age (float): Seconds a cached result stays valid, for stages whose input is an external source.
+
+    Returns:
+        Callable: The decorator that wraps the stage function.
+    """
+    def decorator(func):
+        name = func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not config.cache['enabled']:
+                return func(*args, **kwargs)
+            key = fingerprint(
+                name, args, kwargs,
+                config_values() if config_values else None,
+                [file_fingerprint(file) for file in files()] if files else None
+            )
+            file = os.path.join(config.path['cache'], f'{name}-{key}.pkl')
+            fresh = os.path.exists(file) and (max_age is None or time.time() - os.path.getmtime(file) < max_age)
+            if fresh and name not in _forced:
+                with open(file, 'rb') as f:
+                    return pickle.load(f)
+            result = func(*args, **kwargs)
+            for old_file in glob.glob(os.path.join(config.path['cache'], f'{name}-*.pkl')):
+                os.remove(old_file)
+            with open(f'{file}.tmp', 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f'{file}.tmp', file)
+            #a forced stage only runs once per process
+            _forced.discard(name)
+            return result
+        return wrapper
+    return decorator
@@ -1,8 +1,12 @@
-import os, shutil
+import os, shutil, atexit
+from concurrent.futures import ProcessPoolExecutor
 import config
 
 import pandas as pd
-from ydata_profiling import ProfileReport
+
+#background profiling workers, created on the first background report
+_profile_pool = None
+_pending_profiles = []
 
 def check_directories():
     """Ensure that all configured directories exist on the filesystem.
@@ -23,20 +27,85 @@ def check_directories():
         shutil.copy('Mapa_hidrogeologico_polygon.zip', hidro_file)
 
         
-def profile_dataset(dataset: pd.DataFrame, name: str='name_not_defined', save: bool=False) -> None:
+def profile_settings(dataset: pd.DataFrame, minimal: bool=None) -> tuple:
+    """Reduce a dataset and the report configuration according to the profiling size thresholds.
+    Datasets with more rows than `config.profiling['sample_rows']` are sampled, correlations are skipped
+    above `correlations_max_cols` columns and interactions above `interactions_max_cols` numeric columns.
+    Args:
+        dataset (pd.DataFrame): The dataset to be profiled.
+        minimal (bool): Whether to use the minimal report configuration, by default `config.profiling['minimal']`.
+    Returns:
+        tuple: The dataset to profile and the keyword arguments of the report.
+    """
+    settings = config.profiling
+    minimal = settings['minimal'] if minimal is None else minimal
+    if settings['sample_rows'] and len(dataset)>settings['sample_rows']:
+        dataset = dataset.sample(settings['sample_rows'], random_state=42).sort_index()
+    kwargs = {'minimal': minimal}
+    if dataset.shape[1]>settings['correlations_max_cols']:
+        kwargs['correlations'] = None
+    if dataset.select_dtypes('number').shape[1]>settings['interactions_max_cols']:
+        kwargs['interactions'] = None
+    return dataset, kwargs
+
+def _write_profile(dataset: pd.DataFrame, name: str, save: bool, kwargs: dict):
+    #imported on use, so importing commons for the model registry or serving does not load the profiler
+    from ydata_profiling import ProfileReport
+    profile = ProfileReport(dataset, title=name, **kwargs)
+    if save:
+        # save the report as an HTML file
+        profile.to_file(os.path.join(config.path['data_engineering'], f'{name}.html'))
+    return profile
+
+def _write_profile_file(dataset: pd.DataFrame, name: str, kwargs: dict) -> str:
+    _write_profile(dataset, name, True, kwargs)
+    return os.path.join(config.path['data_engineering'], f'{name}.html')
+
+def profile_dataset(dataset: pd.DataFrame, name: str='name_not_defined', save: bool=False,
+                    stage: str=None, background: bool=None, minimal: bool=None):
     """Generate a profiling report for a given dataset.
     This function uses the ydata_profiling library to create a comprehensive report
     of the dataset's characteristics, including data types, missing values, and
-    statistical summaries.
+    statistical summaries. Large datasets are sampled and the costly sections are skipped
+    according to the size thresholds in `config.profiling`.
     Args:
         dataset (pd.DataFrame): The dataset to be profiled.
         name (str): A name for the dataset, used in the report title and filename.
         save (bool): Whether to save the report as an HTML file in the data engineering directory.
+        stage (str): Pipeline stage of the dataset, stages disabled in `config.profiling['stages']` are not profiled.
+        background (bool): Whether to generate and save the report in a background process, by default
+            `config.profiling['background']`. Only saved reports are generated in the background.
+        minimal (bool): Whether to use the minimal report configuration, by default `config.profiling['minimal']`.
     Returns:
-        ProfileReport: The generated profiling report object.
+        ProfileReport: The generated profiling report object, a Future with the report path when it
+        is generated in the background, or None when the stage profiling is disabled.
     """
-    profile = ProfileReport(dataset, title=name)
-    if save:
-        # save the report as an HTML file
-        profile.to_file(os.path.join(config.path['data_engineering'], f'{name}.html'))
-    return profile
\ No newline at end of file
+    if stage is not None and not config.profiling['stages'].get(stage, True):
+        return None
+    background = config.profiling['background'] if background is None else background
+    dataset, kwargs = profile_settings(dataset, minimal)
+    if background and save:
+        global _profile_pool
+        if _profile_pool is None:
+            _profile_pool = ProcessPoolExecutor(max_workers=config.profiling['max_workers'])
+        future = _profile_pool.submit(_write_profile_file, dataset, name, kwargs)
+        _pending_profiles.append(future)
+        return future
+    return _write_profile(dataset, name, save, kwargs)
+
+def wait_for_profiles() -> list:
+    """Wait for the reports generated in the background and release the profiling workers.
+    Args:
+        None
+    Returns:
+        list: The paths of the saved reports.
+    """
+    global _profile_pool
+    paths = [future.result() for future in _pending_profiles]
+    _pending_profiles.clear()
+    if _profile_pool is not None:
+        _profile_pool.shutdown()
+        _profile_pool = None
+    return paths
+
+atexit.register(wait_for_profiles)
\ No newline at end of file
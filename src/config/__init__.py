@@ -3,4 +3,4 @@ from config.data import (
     salinity_group_use_aliases, salinity_numeric_cols, salinity_cat_cols,
     salinity_correlation_excludes
 )
-from config.general import path
\ No newline at end of file
+from config.general import path, sources, ingestion, imputation, artifacts, profiling, cache, delta, terciles, instrumentation, reporting, registry, server, prediction_grid, search
\ No newline at end of file
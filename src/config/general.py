@@ -7,5 +7,115 @@ path = {
     'precurated_data': os.path.join('output', 'precurated'),
     'data_engineering': os.path.join('output', 'data_engineering'),
     'model_metrics': os.path.join('output', 'model_metrics'),
-    'models': os.path.join('output', 'models')
-}
\ No newline at end of file
+    'models': os.path.join('output', 'models'),
+    'predictions': os.path.join('output', 'predictions'),
+    'cache': os.path.join('output', 'cache'),
+    'search': os.path.join('output', 'search'),
+    'run_reports': os.path.join('output', 'run_reports')
+}
+
+sources = {
+    'salinity': "https://datos-abiertos-igac-igac-oit.hub.arcgis.com/api/download/v1/items/182ec73875ff4d9c8c24f7c1630acf58/csv?layers=0",
+    'salinity_soda': "https://www.datos.gov.co/resource/fwz7-px8j.json"
+}
+
+ingestion = {
+    'mode': 'csv', #'csv' downloads the whole file, 'paginated' fetches the SODA API in concurrent pages
+    'page_size': 10_000,
+    'max_workers': 4,
+    'timeout': 60, #seconds per request
+    'retries': 3
+}
+
+imputation = {
+    'method': 'auto', #'knn' (KNNImputer), 'spatial' (KD-tree on coordinates) or 'auto' (knn up to knn_max_rows)
+    'n_neighbors': 3,
+    'knn_max_rows': 20_000,
+    'coords': ['X', 'Y'],
+    'feature_weights': {}, #additional features used to find the spatial neighbors, by weight
+    'block_size': 50_000, #records queried at once by the spatial imputer
+    'n_jobs': None #worker processes of the spatial imputer, None uses all the available cores
+}
+
+artifacts = {
+    'format': 'parquet', #'parquet' or 'csv'
+    'compression': 'zstd',
+    'export_csv': False #also export a CSV copy of the Parquet artifacts
+}
+
+profiling = {
+    'background': True, #generate the saved reports in background processes while the pipeline continues
+    'max_workers': 2,
+    'minimal': False,
+    'sample_rows': 50_000, #rows sampled from larger datasets, None profiles every row
+    'correlations_max_cols': 30,
+    'interactions_max_cols': 10,
+    'stages': {'raw': True, 'precurated': True, 'curated': True} #profiled pipeline stages
+}
+
+cache = {
+    'enabled': True,
+    'source_max_age': 12*3600 #seconds before the downloaded salinity source is fetched again
+}
+
+delta = {
+    'key': 'OBJECTID', #column identifying a record of the salinity source, it is read before the cleaning drops it
+    'refit_policy': 'drift', #'never' keeps the tercile thresholds, 'always' refits them every run, 'drift' after refit_drift_share of the records changed
+    'refit_drift_share': 0.1, #share of new, changed and removed records since the last fit that triggers a 'drift' refit
+    'report_flips': True #fit candidate thresholds every run to report how many labels a refit would flip
+}
+
+terciles = {
+    'method': 'binned', #'binned' fits n_bins quantile bins, 'subsample' a stratified sample of sample_size values, 'full' every value
+    'n_bins': 512,
+    'sample_size': 50_000,
+    'start_sample': 2_000, #values of the stratified sample the starting parameters are estimated on
+    'warm_start': True, #also start from the parameters of the last cached fit
+    'bootstrap': 0, #resamples of the bootstrap confidence intervals of the thresholds, 0 skips them
+    'confidence': 0.95,
+    'n_jobs': None, #worker processes of the bootstrap, None uses all the available cores
+    'plot': True, #write the histogram with the fitted distribution to the curated data directory
+    'random_state': 42
+}
+
+instrumentation = {
+    'enabled': True, #record the time, CPU, memory and rows of each stage and fold in a JSON run report
+    'profile_stage': None #name of a stage run under cProfile, e.g. 'input_numeric_cols'
+}
+
+reporting = {
+    'fpr_points': 101, #points of the FPR grid of the aggregated ROC curves
+    'store': 'cv_metrics' #Parquet metrics store in the model metrics directory
+}
+
+registry = {
+    'cache_size': 4 #models kept loaded per process
+}
+
+server = {
+    'host': '127.0.0.1',
+    'port': 8050,
+    'model': 'Voting', #pipeline of the model registry served
+    'max_batch': 512, #points predicted in one predict_proba call
+    'max_wait_ms': 2, #time a batch waits for more points after its first one
+    'cache_size': 100_000, #answers kept in the LRU cache
+    'round_decimals': 0, #decimals of the coordinates in the cache key, 0 rounds to the meter
+    'latency_window': 10_000 #recent requests and batches used for the latency percentiles
+}
+
+prediction_grid = {
+    'chunk_size': 250_000, #cells predicted per worker task
+    'n_jobs': None, #worker processes, None uses all the available cores
+    'nodata': 255 #class code for cells outside the hydrogeologic map
+}
+
+search = {
+    'n_candidates': 60, #valid combinations sampled from each search space
+    'eta': 3, #each rung keeps 1/eta of the candidates and trains them on eta times more rows
+    'min_fraction': 0.1, #smallest fraction of the training folds used in the first rung
+    'folds': 5,
+    'scoring': 'f1_macro', #'f1_macro', 'balanced_accuracy' or 'roc_auc_ovr_weighted'
+    'max_seconds': 1800, #per model, no new rung is started after it, None for no limit
+    'n_jobs': None, #worker processes, None uses all the available cores
+    'random_state': 42
+}
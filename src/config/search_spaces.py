@@ -0,0 +1,67 @@
+#hyperparameter search spaces of the classifiers, by the model names of models_args.py
+#estimator: dotted path of the classifier class, fixed: arguments that are not searched, space: values of each searched argument
+LogisticRegression = {
+    'estimator': 'sklearn.linear_model.LogisticRegression',
+    'fixed': {'solver': 'saga'},
+    'space': {
+        'C': [0.1, 0.4, 0.8, 0.9, 1, 10], 'penalty': ['l1', 'l2', 'elasticnet'],
+        'l1_ratio': [0, 0.2, 0.4, 0.6, 0.08, 1], #only used by the elasticnet penalty
+        'max_iter': [100, 200, 400, 600, 800, 1000, 1400]
+    }
+}
+
+KNN = {
+    'estimator': 'sklearn.neighbors.KNeighborsClassifier',
+    'fixed': {},
+    'space': {'n_neighbors': [2, 4, 5, 6, 7, 8, 11, 21], 'weights': ['uniform', 'distance'], 'p': [1, 2]}
+}
+
+SVM = {
+    'estimator': 'sklearn.svm.SVC',
+    'fixed': {'probability': True},
+    'space': {
+        'kernel': ['rbf', 'linear', 'poly', 'sigmoid'], 'C': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+        'gamma': ['scale', 'auto'] #ignored by the linear kernel
+    }
+}
+
+DecisionTree = {
+    'estimator': 'sklearn.tree.DecisionTreeClassifier',
+    'fixed': {'random_state': 42},
+    'space': {
+        'max_depth': [None, 5, 10, 20, 30, 40, 50], 'min_samples_split': [2, 4, 5, 6, 7, 8, 9, 10],
+        'min_samples_leaf': [1, 2, 3, 4, 5, 6], 'criterion': ['gini', 'entropy'], 'max_features': [None, 'sqrt']
+    }
+}
+
+XGBoost = {
+    'estimator': 'xgboost.XGBClassifier',
+    'fixed': {
+        'use_label_encoder': False, 'eval_metric': 'mlogloss', 'random_state': 42, 'verbosity': 0, 'device': 'cpu',
+        'tree_method': 'hist'
+    },
+    'space': {
+        'n_estimators': [200, 400], 'max_depth': [4, 5, 6], 'learning_rate': [0.01, 0.05], 'subsample': [0.6, 0.8],
+        'colsample_bytree': [0.8, 1.0], 'reg_alpha': [0, 0.5], 'reg_lambda': [0, 1], 'gamma': [0, 0.1]
+    }
+}
+
+RandomFores = {
+    'estimator': 'sklearn.ensemble.RandomForestClassifier',
+    'fixed': {'random_state': 42},
+    'space': {
+        'n_estimators': [100, 200, 300], 'max_depth': [None, 10, 20, 30], 'min_samples_split': [2, 5, 10],
+        'min_samples_leaf': [1, 2, 4], 'max_features': ['sqrt', 'log2', None], 'bootstrap': [True, False],
+        'criterion': ['gini', 'entropy', 'log_loss'] #log_loss is the same criterion as entropy
+    }
+}
+
+NeuralNetwork = {
+    'estimator': 'sklearn.neural_network.MLPClassifier',
+    'fixed': {'random_state': 42},
+    'space': {
+        'hidden_layer_sizes': [(5,), 10, (10, 5), (10, 50), (10, 5, 3)], 'activation': ['tanh', 'relu', 'logistic'],
+        'solver': ['adam', 'sgd'], 'alpha': [0.0001, 0.001, 0.01], 'learning_rate_init': [0.001, 0.01, 0.1],
+        'max_iter': [500, 1000, 1500]
+    }
+}
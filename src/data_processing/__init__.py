@@ -1 +1,2 @@
-from .salinity_process import process_data
\ No newline at end of file
+from .salinity_process import process_data
+from .delta import process_delta
@@ -0,0 +1,92 @@
+from functools import lru_cache
+import config
+
+import pandas as pd, numpy as np
+
+#values taken as missing in text columns: the empty string and up to four spaces
+BLANK_SENTINELS = [' '*i for i in range(5)]
+
+
+@lru_cache(maxsize=1)
+def build_cleaning_plan() -> dict:
+    """Compile the column cleaning plan from the salinity data definitions in `config.data`.
+    The plan is built once per process and tells, for every column of the salinity data dictionary,
+    whether it is dropped, parsed as a number or cleaned as text, along with the category aliases
+    resolved into a single lookup table.
+
+    Returns:
+        dict: The cleaning plan with the 'drop_cols', 'float_cols', 'int_cols', 'text_cols',
+        the 'aliases' lookup of each column and the final 'dtypes' of the non-float columns.
+    """
+    drop_cols = list(dict.fromkeys(config.salinity_exclude_cols + config.salinity_missing_cols))
+    kept = {col: typ for col, typ in config.salinity_data_dictionary.items() if col not in drop_cols}
+    #resolving the aliases in the same order the labels are defined, so a label that is also an
+    #alias of a later group ends up with the later label
+    use_aliases = dict()
+    for label, aliases in config.salinity_group_use_aliases.items():
+        use_aliases.update({key: label for key, value in use_aliases.items() if value in aliases})
+        use_aliases.update({alias: label for alias in aliases if alias not in use_aliases})
+    return {
+        'drop_cols': drop_cols,
+        'float_cols': [col for col, typ in kept.items() if typ==float],
+        'int_cols': [col for col, typ in kept.items() if typ==int],
+        'text_cols': [col for col, typ in kept.items() if typ in [str, 'category']],
+        'aliases': {'Uso_del_Su': use_aliases},
+        'dtypes': {col: typ for col, typ in kept.items() if typ!=float}
+    }
+
+def parse_float(values: pd.Series) -> pd.Series:
+    """Parse a raw column into floats in a single vectorized pass.
+    Text values keep only their digits and decimal separators, with commas read as decimal points,
+    so signs, units and letters are discarded. Values left empty become NaN. Numeric columns skip the
+    text round trip, unless they hold magnitudes that `str` writes in exponent notation.
+
+    Args:
+        values (pd.Series): Raw column values.
+
+    Returns:
+        pd.Series: The parsed float column.
+    """
+    if values.dtype.kind in 'iuf':
+        numbers = np.abs(values.to_numpy(dtype=float))
+        numbers[np.isinf(numbers)] = np.nan
+        if not ((numbers!=0)&((numbers<1e-4)|(numbers>=1e16))).any():
+            return pd.Series(numbers, index=values.index, name=values.name)
+    text = values.astype(str).str.replace('[^0-9.,]', '', regex=True).str.replace(',', '.', regex=False)
+    return text.mask(text=='').astype(float)
+
+def clean_int(values: pd.Series) -> pd.Series:
+    """Keep only the alphanumeric characters and decimal separators of an integer column, empty values become NaN."""
+    text = values.astype(str).str.replace('[^a-zA-Z0-9.,]', '', regex=True)
+    return text.mask(text=='')
+
+def map_aliases(values: pd.Series, aliases: dict) -> pd.Series:
+    """Replace the aliases of a column by their label, looking up each distinct value only once."""
+    codes, uniques = pd.factorize(values)
+    labels = np.array([aliases.get(value, value) for value in uniques] + [np.nan], dtype=object)
+    return pd.Series(labels[codes], index=values.index, name=values.name)
+
+def clean_salinity(salinity: pd.DataFrame) -> pd.DataFrame:
+    """Apply the cleaning plan to a raw salinity dataset.
+    Excluded and mostly missing columns are dropped first, then every remaining column of the data
+    dictionary is parsed once. Zero readings are kept as values. Records with 5 or more missing
+    values are removed, category aliases are mapped to their labels and the dictionary dtypes are set.
+
+    Args:
+        salinity (pd.DataFrame): The raw salinity dataset, it is not modified.
+
+    Returns:
+        pd.DataFrame: The cleaned salinity dataset, keeping the index of the remaining records.
+    """
+    plan = build_cleaning_plan()
+    salinity = salinity.drop(plan['drop_cols'], axis=1)
+    columns = {col: parse_float(salinity[col]) for col in plan['float_cols']}
+    columns.update({col: clean_int(salinity[col]) for col in plan['int_cols']})
+    columns.update({col: salinity[col].mask(salinity[col].isin(BLANK_SENTINELS)) for col in plan['text_cols']})
+    salinity = salinity.assign(**columns)
+    #excluding registers with more than 5 mising values
+    salinity = salinity[salinity.isna().sum(axis=1)<5]
+    salinity = salinity.assign(**{
+        col: map_aliases(salinity[col], aliases) for col, aliases in plan['aliases'].items()
+    })
+    return salinity.astype(plan['dtypes'])
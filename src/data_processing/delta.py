@@ -0,0 +1,284 @@
+import os, json
+from datetime import datetime, timezone
+import config
+
+import pandas as pd, numpy as np
+from sklearn.impute import KNNImputer
+
+from commons import read_artifact, write_artifact, lookup_class_hidr, salinity_crs, fingerprint, file_fingerprint
+from commons import trace, traced, record_span
+from commons.artifacts import artifact_path
+from commons.spatial_index import hidrogeology_file
+from data_processing.cleaning import clean_salinity, build_cleaning_plan
+from data_processing.imputation import spatial_impute
+from data_processing.salinity_process import get_salinity, assign_categories, finalize_dataset
+from data_processing.terciles import fit_terciles
+
+#keyed intermediate artifact, one row per source record with its hash and its processed values
+KEYED = 'salinity_keyed'
+TERCILES = 'salinity_terciles.json'
+
+
+def _state_file(name: str) -> str:
+    return os.path.join(config.path['curated_data'], name)
+
+def _read_json(name: str, default: dict) -> dict:
+    if not os.path.exists(_state_file(name)):
+        return default
+    with open(_state_file(name)) as f:
+        return json.load(f)
+
+def _write_json(value: dict, name: str) -> None:
+    with open(_state_file(name), 'w') as f:
+        json.dump(value, f, indent=2)
+
+def settings_fingerprint() -> str:
+    """Hash of the configuration and the hydrogeologic map the keyed records were processed with.
+    When it changes, every record of the source is processed again."""
+    return fingerprint(
+        config.delta['key'], config.salinity_data_dictionary, config.salinity_exclude_cols,
+        config.salinity_missing_cols, config.salinity_group_use_aliases, config.imputation,
+        file_fingerprint(hidrogeology_file())
+    )
+
+def row_hashes(salinity: pd.DataFrame, key: str) -> pd.Series:
+    """Hash every record of the raw salinity source.
+    Numeric columns are hashed as floats, so a record does not change when pandas infers integers
+    for a column in one download and floats in the next.
+
+    Args:
+        salinity (pd.DataFrame): The raw salinity dataset.
+        key (str): Column that identifies the records.
+
+    Returns:
+        pd.Series: The uint64 hash of each record, indexed by its key.
+    """
+    if key not in salinity.columns:
+        raise ValueError(f'The salinity source has no {key} column to identify its records, set config.delta["key"]')
+    keys = salinity[key]
+    if keys.isna().any() or keys.duplicated().any():
+        raise ValueError(f'The {key} column has missing or duplicated values, it cannot identify the records')
+    values = salinity.drop(columns=key)
+    values = values[sorted(values.columns)]
+    values = values.astype({col: float for col in values.columns if values[col].dtype.kind in 'iub'})
+    return pd.Series(pd.util.hash_pandas_object(values, index=False).to_numpy(), index=pd.Index(keys, name=key), name='row_hash')
+
+def diff_records(hashes: pd.Series, previous: pd.Series) -> dict:
+    """Compare the record hashes of the source with the ones of the keyed artifact.
+
+    Args:
+        hashes (pd.Series): Hashes of the current source records, indexed by key.
+        previous (pd.Series): Hashes of the processed records, indexed by key.
+
+    Returns:
+        dict: The 'new', 'changed' and 'removed' keys and the number of 'unchanged' records.
+    """
+    known = hashes.index.isin(previous.index)
+    common = hashes[known]
+    changed = common.index[common.to_numpy()!=previous.reindex(common.index).to_numpy()]
+    return {
+        'new': hashes.index[~known], 'changed': changed,
+        'removed': previous.index[~previous.index.isin(hashes.index)], 'unchanged': len(common) - len(changed)
+    }
+
+def _imputed_bits(n_cols: int) -> np.ndarray:
+    return np.left_shift(1, np.arange(n_cols, dtype=np.int64))
+
+def observed_values(keyed: pd.DataFrame) -> pd.DataFrame:
+    """Numeric values of the keyed records as they were measured, with the imputed ones set back to NaN."""
+    values = keyed[config.salinity_numeric_cols].to_numpy(dtype=float, copy=True)
+    mask = keyed['imputed_mask'].to_numpy(dtype=np.int64)[:, None] & _imputed_bits(values.shape[1])
+    values[mask!=0] = np.nan
+    return pd.DataFrame(values, columns=config.salinity_numeric_cols, index=keyed.index)
+
+def impute_records(observed: pd.DataFrame, targets: np.ndarray) -> np.ndarray:
+    """Impute the missing numeric values of the target records, taking every record as a candidate neighbor.
+    The method follows `config.imputation` as in `input_numeric_cols`, choosing 'knn' or 'spatial' on the
+    number of records. Each target gets the values a full imputation of `observed` would give it.
+
+    Args:
+        observed (pd.DataFrame): Numeric values of the kept records as they were measured.
+        targets (np.ndarray): Boolean mask of the records to impute.
+
+    Returns:
+        np.ndarray: The imputed numeric values of the target records.
+    """
+    method = config.imputation['method']
+    if method=='spatial' or (method=='auto' and len(observed)>config.imputation['knn_max_rows']):
+        return spatial_impute(observed, targets=targets).to_numpy()[targets]
+    imputer = KNNImputer(n_neighbors=config.imputation['n_neighbors']).fit(observed)
+    return imputer.transform(observed[targets])
+
+@traced
+def clean_records(salinity: pd.DataFrame, key: str, hashes: pd.Series) -> pd.DataFrame:
+    """Clean a subset of the raw salinity records into keyed records.
+    Records that the cleaning discards are kept with `kept` False, so they are not processed again until they change.
+
+    Args:
+        salinity (pd.DataFrame): Raw records to process.
+        key (str): Column that identifies the records.
+        hashes (pd.Series): Hashes of the source records, indexed by key.
+
+    Returns:
+        pd.DataFrame: The keyed records, indexed by key, with their hash, the numeric columns as measured,
+        the bit mask of the missing numeric columns, the categorical columns and an empty 'class_hidr'.
+    """
+    keys = pd.Index(salinity[key], name=key)
+    cleaned = clean_salinity(salinity.set_axis(keys, axis=0))
+    numeric = cleaned[config.salinity_numeric_cols].astype(float)
+    records = pd.DataFrame({'row_hash': hashes.reindex(keys).to_numpy(), 'kept': keys.isin(cleaned.index)}, index=keys)
+    records = records.reindex(columns=['row_hash', 'kept'] + config.salinity_numeric_cols + ['imputed_mask']
+                              + config.salinity_cat_cols + ['class_hidr'])
+    records = records.astype({col: object for col in config.salinity_cat_cols + ['class_hidr']})
+    if len(cleaned):
+        records.loc[cleaned.index, config.salinity_numeric_cols] = numeric
+        records.loc[cleaned.index, 'imputed_mask'] = (numeric.isna().to_numpy()*_imputed_bits(numeric.shape[1])).sum(axis=1)
+        records.loc[cleaned.index, config.salinity_cat_cols] = cleaned[config.salinity_cat_cols].astype(object)
+    return records.assign(imputed_mask=records['imputed_mask'].fillna(0).astype(np.int64))
+
+@traced
+def impute_keyed(keyed: pd.DataFrame, targets: np.ndarray) -> pd.DataFrame:
+    """Impute the target records of the keyed artifact and look up their hydrogeologic class.
+
+    Args:
+        keyed (pd.DataFrame): Keyed records, in the order of the source.
+        targets (np.ndarray): Boolean mask of the kept records to impute and join.
+
+    Returns:
+        pd.DataFrame: The keyed records with the imputed values and 'class_hidr' of the targets.
+    """
+    kept = keyed['kept'].to_numpy()
+    if not targets.any():
+        return keyed
+    observed = observed_values(keyed[kept])
+    imputed = impute_records(observed, targets[kept])
+    rows = keyed.index[targets]
+    keyed.loc[rows, config.salinity_numeric_cols] = imputed
+    keyed.loc[rows, 'class_hidr'] = lookup_class_hidr(keyed.loc[rows, 'X'], keyed.loc[rows, 'Y'], crs=salinity_crs())
+    return keyed
+
+def load_keyed() -> pd.DataFrame:
+    """Load the keyed artifact indexed by key, None when there is none or it was processed with other settings."""
+    state = _read_json(f'{KEYED}.json', {})
+    if state.get('settings')!=settings_fingerprint() or not os.path.exists(artifact_path(KEYED, config.path['curated_data'])):
+        return None
+    return read_artifact(KEYED, config.path['curated_data']).set_index(state['key'])
+
+def load_thresholds() -> dict:
+    """Versions of the tercile thresholds, with the one in use in 'current' and the records changed since its fit."""
+    return _read_json(TERCILES, {'current': None, 'changes_since_fit': 0, 'versions': []})
+
+def current_thresholds(history: dict=None) -> dict:
+    """Tercile thresholds in use, None before the first fit."""
+    history = history or load_thresholds()
+    return history['versions'][history['current'] - 1] if history['current'] else None
+
+def label_flips(values: pd.Series, thresholds: dict, candidate: dict) -> int:
+    """Number of records whose salinity category changes from some thresholds to the candidate ones."""
+    labels = [
+        assign_categories(pd.DataFrame({'SAL': values}), item['q1'], item['q2'])['CATEGORIA_SAL'].fillna('')
+        for item in (thresholds, candidate)
+    ]
+    return int((labels[0]!=labels[1]).sum())
+
+def refit_reason(history: dict, records: int, refit: bool=False) -> str:
+    """Why the tercile thresholds are fitted again following `config.delta['refit_policy']`, None to keep them."""
+    policy = config.delta['refit_policy']
+    if policy not in ('never', 'always', 'drift'):
+        raise ValueError(f"Unknown refit policy {policy}, use 'never', 'always' or 'drift'")
+    if refit:
+        return 'requested'
+    if not history['versions']:
+        return 'initial'
+    if policy=='always':
+        return 'always'
+    if policy=='drift' and history['changes_since_fit']>=config.delta['refit_drift_share']*records:
+        return 'drift'
+    return None
+
+@traced
+def update_thresholds(values: pd.Series, changes: int, refit: bool=False) -> tuple:
+    """Apply the refit policy to the versioned tercile thresholds.
+    Candidate thresholds are fitted when the policy refits or `config.delta['report_flips']` is set, and
+    the labels they would flip are counted against the thresholds in use. A refit adds a new version.
+
+    Args:
+        values (pd.Series): Salinity values of the labeled records.
+        changes (int): New, changed and removed records of this run.
+        refit (bool): Whether to refit the thresholds whatever the policy.
+
+    Returns:
+        tuple: The thresholds in use after the run and a report of the refit.
+    """
+    history = load_thresholds()
+    history['changes_since_fit'] += changes
+    reason, thresholds = refit_reason(history, len(values), refit), current_thresholds(history)
+    candidate = fit_terciles(values) if reason or config.delta['report_flips'] else None
+    flips = label_flips(values, thresholds, candidate) if thresholds and candidate else None
+    if reason:
+        thresholds = {
+            'version': len(history['versions']) + 1, 'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'reason': reason, 'records': len(values), 'label_flips': flips
+        } | candidate
+        history['versions'].append(thresholds)
+        history.update(current=thresholds['version'], changes_since_fit=0)
+    _write_json(history, TERCILES)
+    return thresholds, {
+        'thresholds_version': thresholds['version'], 'refit': reason, 'changes_since_fit': history['changes_since_fit'],
+        'label_flips': flips, 'label_flip_share': flips/len(values) if flips is not None and len(values) else None
+    }
+
+@traced
+def process_delta(refit_terciles: bool=False) -> dict:
+    """Update the curated salinity dataset with the records that changed in the source since the last run.
+    The records are identified by `config.delta['key']` and compared by a hash of their raw values. Only
+    the new and changed records are cleaned and merged into the keyed artifact, where removed records are
+    dropped. The new and changed records are imputed, with every record as a candidate neighbor, and
+    spatially joined. As their neighbors may have changed, the records with imputed values are imputed
+    again, so the result matches a full rebuild, while the records measured in full are not touched.
+    The first run, and any run after the cleaning, imputation or hydrogeologic map settings change, processes every record.
+    The curated artifact is then assembled from the keyed one, labeled with the versioned tercile thresholds
+    of `salinity_terciles.json`, which are refitted following `config.delta['refit_policy']`.
+    The pre-curated artifact and the profiling reports are only produced by `process_data`.
+
+    Args:
+        refit_terciles (bool): Whether to refit the tercile thresholds whatever the policy.
+
+    Returns:
+        dict: Report of the run with the new, changed, removed and unchanged records, the records dropped
+        by the cleaning, the thresholds version and the labels a refit would flip. It is also recorded in the run report.
+    """
+    key = config.delta['key']
+    salinity = get_salinity()
+    with trace('diff_records', rows_in=len(salinity)):
+        hashes = row_hashes(salinity, key)
+        keyed = load_keyed()
+        rebuild = keyed is None
+        previous = keyed['row_hash'] if keyed is not None else pd.Series(dtype=np.uint64, index=pd.Index([], name=key))
+        diff = diff_records(hashes, previous)
+    if keyed is not None:
+        keyed = keyed.drop(diff['changed'].append(diff['removed']))
+    pending = salinity[salinity[key].isin(diff['new'].append(diff['changed']))]
+    records = clean_records(pending, key, hashes)
+    keyed = pd.concat([keyed, records]) if keyed is not None else records
+    keyed = keyed.reindex(hashes.index)
+    changes = len(diff['new']) + len(diff['changed']) + len(diff['removed'])
+    #when the records change, the neighbors of the records with imputed values may change too
+    targets = keyed.index.isin(records.index) | (keyed['imputed_mask'].to_numpy()!=0 if changes else False)
+    keyed = impute_keyed(keyed, targets & keyed['kept'].to_numpy())
+    write_artifact(keyed.reset_index(), KEYED, config.path['curated_data'])
+    _write_json({'key': key, 'settings': settings_fingerprint(), 'records': len(keyed),
+                 'updated_at': datetime.now(timezone.utc).isoformat(timespec='seconds')}, f'{KEYED}.json')
+
+    dataset = keyed[keyed['kept'] & keyed['class_hidr'].notna()]
+    dataset = dataset[config.salinity_numeric_cols + config.salinity_cat_cols + ['class_hidr']].reset_index(drop=True)
+    dataset = dataset.astype({col: build_cleaning_plan()['dtypes'][col] for col in config.salinity_cat_cols})
+    thresholds, refit = update_thresholds(dataset['SAL'], changes, refit_terciles)
+    finalize_dataset(assign_categories(dataset, thresholds['q1'], thresholds['q2']))
+    report = {
+        'records': len(hashes), 'new': len(diff['new']), 'changed': len(diff['changed']), 'removed': len(diff['removed']),
+        'unchanged': diff['unchanged'], 'dropped_by_cleaning': int((~records['kept']).sum()),
+        'full_rebuild': rebuild
+    } | refit
+    record_span('delta_ingestion', **report)
+    return report
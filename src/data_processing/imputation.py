@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor
+import config
+
+import pandas as pd, numpy as np
+from scipy.spatial import cKDTree
+
+#neighbor search space shared by the tasks of each worker process
+_shared_space = {}
+
+
+def _init_search_space(space: np.ndarray, located: np.ndarray, targets: np.ndarray) -> None:
+    _shared_space.update(space=space, located=located, targets=targets)
+
+def search_space(dataset: pd.DataFrame, coords: list, feature_weights: dict=None) -> np.ndarray:
+    """Build the space where the neighbors of each record are searched.
+    The coordinates are used as they are. Each weighted feature is standardized and rescaled so that
+    one standard deviation of the feature, times its weight, spans the mean standard deviation of the
+    coordinates. Missing feature values are filled with the feature median, only for the search.
+
+    Args:
+        dataset (pd.DataFrame): Dataset with the coordinate and feature columns.
+        coords (list): Names of the coordinate columns.
+        feature_weights (dict): Weight of each additional feature used to find neighbors.
+
+    Returns:
+        np.ndarray: Array with one row per record and one column per coordinate and weighted feature.
+    """
+    space = dataset[coords].to_numpy(dtype=float)
+    if not feature_weights:
+        return space
+    spread = np.nanmean(np.nanstd(space, axis=0))
+    features = []
+    for col, weight in feature_weights.items():
+        values = dataset[col].to_numpy(dtype=float)
+        values = np.where(np.isnan(values), np.nanmedian(values), values)
+        std = values.std() or 1.0
+        features.append((values - values.mean())/std*spread*weight)
+    return np.column_stack([space] + features)
+
+def _impute_column(values: np.ndarray, dims: list, n_neighbors: int, block_size: int) -> np.ndarray:
+    """Fill the missing values of the target records of a column with the mean of the nearest records where it is known."""
+    space, located, targets = _shared_space['space'][:, dims], _shared_space['located'], _shared_space['targets']
+    values = values.copy()
+    known = ~np.isnan(values) & located
+    if not known.any():
+        return values
+    known_values = values[known]
+    missing = np.flatnonzero(np.isnan(values) & located & targets)
+    tree = cKDTree(space[known]) if len(missing) else None
+    k = min(n_neighbors, len(known_values))
+    for start in range(0, len(missing), block_size):
+        block = missing[start:start + block_size]
+        _, neighbors = tree.query(space[block], k=k)
+        values[block] = known_values[neighbors.reshape(len(block), k)].mean(axis=1)
+    #records without coordinates cannot be located, they get the column mean
+    values[np.isnan(values) & ~located & targets] = known_values.mean()
+    return values
+
+def spatial_impute(dataset: pd.DataFrame, coords: list=None, n_neighbors: int=None, feature_weights: dict=None,
+                   block_size: int=None, n_jobs: int=None, targets: np.ndarray=None) -> pd.DataFrame:
+    """Impute missing values with the mean of the geographically nearest records.
+    For each column, a KD-tree is built over the records where the column is known, and the
+    records where it is missing are queried in blocks of bounded size. Columns are imputed in
+    parallel worker processes. Records with missing coordinates keep them missing, so they are
+    dropped when the hydrogeologic class is looked up, and the rest of their values get the column mean.
+    With `targets`, every record is a candidate neighbor but only the missing values of the target records
+    are imputed, e.g. the new records of a delta ingestion.
+
+    Args:
+        dataset (pd.DataFrame): Numeric dataset with the coordinate columns.
+        coords (list): Names of the coordinate columns, by default `config.imputation['coords']`.
+        n_neighbors (int): Number of neighbors averaged, by default `config.imputation['n_neighbors']`.
+        feature_weights (dict): Weight of each additional feature used to find neighbors, by default
+            `config.imputation['feature_weights']`.
+        block_size (int): Records queried at once, by default `config.imputation['block_size']`.
+        n_jobs (int): Number of worker processes, 1 runs in the current process. By default `config.imputation['n_jobs']`.
+        targets (np.ndarray): Boolean mask of the records whose missing values are imputed, by default all of them.
+
+    Returns:
+        pd.DataFrame: The dataset with the missing values imputed.
+    """
+    coords = coords or config.imputation['coords']
+    n_neighbors = n_neighbors or config.imputation['n_neighbors']
+    feature_weights = config.imputation['feature_weights'] if feature_weights is None else feature_weights
+    block_size = block_size or config.imputation['block_size']
+    n_jobs = n_jobs if n_jobs is not None else config.imputation['n_jobs']
+    space = search_space(dataset, coords, feature_weights)
+    located = ~np.isnan(dataset[coords].to_numpy(dtype=float)).any(axis=1)
+    targets = np.ones(len(dataset), dtype=bool) if targets is None else np.asarray(targets, dtype=bool)
+    columns = [col for col in dataset.columns if col not in coords and dataset.loc[targets, col].isna().any()]
+    #a weighted feature is not used to search the neighbors of its own missing values
+    space_cols = list(coords) + list(feature_weights or {})
+    dims = {col: [i for i, space_col in enumerate(space_cols) if space_col!=col] for col in columns}
+    imputed = dataset.copy()
+    if n_jobs == 1:
+        _init_search_space(space, located, targets)
+        for col in columns:
+            imputed[col] = _impute_column(dataset[col].to_numpy(dtype=float), dims[col], n_neighbors, block_size)
+    elif columns:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_search_space, initargs=(space, located, targets)) as pool:
+            futures = {
+                col: pool.submit(_impute_column, dataset[col].to_numpy(dtype=float), dims[col], n_neighbors, block_size)
+                for col in columns
+            }
+            for col, future in futures.items():
+                imputed[col] = future.result()
+    return imputed
@@ -0,0 +1,128 @@
+import os, re, json, glob, time, unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import config
+
+import pandas as pd
+import requests
+
+from commons import read_artifact, write_artifact
+
+
+def pages_directory() -> str:
+    """Directory where the downloaded pages of the salinity dataset and their manifest are stored."""
+    return os.path.join(config.path['raw_data'], 'salinity_pages')
+
+def _load_manifest() -> dict:
+    file_path = os.path.join(pages_directory(), 'manifest.json')
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as f:
+        return json.load(f)
+
+def _save_manifest(manifest: dict) -> None:
+    file_path = os.path.join(pages_directory(), 'manifest.json')
+    with open(f'{file_path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f'{file_path}.tmp', file_path)
+
+def _session() -> requests.Session:
+    session = requests.Session()
+    token = os.environ.get('SODA_APP_TOKEN')
+    if token:
+        session.headers['X-App-Token'] = token
+    return session
+
+def _get(session: requests.Session, url: str, params: dict, headers: dict=None) -> requests.Response:
+    """GET request retried with exponential backoff on connection errors and server errors."""
+    retries = config.ingestion['retries']
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, params=params, headers=headers, timeout=config.ingestion['timeout'])
+            if response.status_code < 500:
+                response.raise_for_status()
+                return response
+            if attempt == retries:
+                response.raise_for_status()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        time.sleep(2**attempt)
+
+def _page_name(page: int) -> str:
+    return f'page-{page:05d}'
+
+def _fetch_page(session: requests.Session, url: str, page: int, page_size: int) -> int:
+    """Download a page of the dataset and write it to disk as soon as it arrives.
+    The page is only recorded in the manifest after it is written, so a partial file is fetched again on resume."""
+    response = _get(session, url, {'$limit': page_size, '$offset': page*page_size, '$order': ':id'})
+    write_artifact(pd.DataFrame(response.json()), _page_name(page), pages_directory(), fmt='parquet', export_csv=False)
+    return page
+
+def api_field_name(name: str) -> str:
+    """Field name the Socrata portal gives to a column: lowercase, without accents, with every run of
+    characters other than letters and digits replaced by an underscore and no leading or trailing underscores."""
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().lower()
+    return re.sub('[^a-z0-9]+', '_', name).strip('_')
+
+def _match_columns(salinity: pd.DataFrame) -> pd.DataFrame:
+    """Rename the API field names to the names of the salinity data dictionary, e.g. 'metodo_de' to 'Método_de'."""
+    names = {api_field_name(col): col for col in config.salinity_data_dictionary}
+    return salinity.rename(columns={
+        col: names[api_field_name(col)] for col in salinity.columns if api_field_name(col) in names
+    })
+
+def _assemble_pages(n_pages: int) -> pd.DataFrame:
+    pages = [read_artifact(_page_name(page), pages_directory(), fmt='parquet') for page in range(n_pages)]
+    return _match_columns(pd.concat(pages, ignore_index=True)) if pages else pd.DataFrame()
+
+def ingest_salinity(url: str) -> pd.DataFrame:
+    """Download the salinity dataset from a Socrata (SODA) API endpoint in concurrent pages.
+    The number of records is requested first, as a conditional request with the validators of the
+    last complete download, so an unchanged source is loaded from the stored pages. Otherwise the
+    pages are fetched by a bounded thread pool and each one is written to disk when it arrives. The
+    manifest records the completed pages, so an interrupted download resumes from where it stopped.
+
+    Args:
+        url (str): Resource endpoint of the dataset, e.g. `https://www.datos.gov.co/resource/<id>.json`.
+
+    Returns:
+        pd.DataFrame: The salinity dataset, with the column names of the salinity data dictionary.
+    """
+    os.makedirs(pages_directory(), exist_ok=True)
+    manifest, session = _load_manifest(), _session()
+    headers = dict()
+    if manifest.get('complete') and manifest.get('url') == url:
+        if manifest.get('etag'):
+            headers['If-None-Match'] = manifest['etag']
+        if manifest.get('last_modified'):
+            headers['If-Modified-Since'] = manifest['last_modified']
+    response = _get(session, url, {'$select': 'count(*)'}, headers=headers)
+    if response.status_code == 304:
+        return _assemble_pages(manifest['n_pages'])
+    count = int(response.json()[0]['count'])
+    page_size = config.ingestion['page_size']
+    source = {
+        'url': url, 'count': count, 'page_size': page_size, 'n_pages': -(-count // page_size),
+        'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')
+    }
+    #starting over when the source or the paging changed since the stored pages were downloaded
+    if any(manifest.get(key) != value for key, value in source.items()):
+        for file_path in glob.glob(os.path.join(pages_directory(), 'page-*.parquet')):
+            os.remove(file_path)
+        manifest = source | {'pages': [], 'complete': False}
+    pending = [page for page in range(source['n_pages']) if page not in manifest['pages']]
+    errors = []
+    with ThreadPoolExecutor(max_workers=config.ingestion['max_workers']) as pool:
+        futures = [pool.submit(_fetch_page, session, url, page, page_size) for page in pending]
+        #recording every page that arrives, also after another page failed, so a resume only fetches the failed ones
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                errors.append(future.exception())
+                continue
+            manifest['pages'].append(future.result())
+            _save_manifest(manifest)
+    if errors:
+        raise errors[0]
+    manifest['complete'] = True
+    _save_manifest(manifest)
+    return _assemble_pages(source['n_pages'])
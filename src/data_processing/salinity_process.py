@@ -1,103 +1,109 @@
 import config, os
-import plotly.express as px, plotly.graph_objects as go
 from sklearn.impute import KNNImputer
-import pandas as pd, numpy as np
-from scipy import stats
-import geopandas as gpd
+import pandas as pd
 
-from commons import profile_dataset
+from commons import profile_dataset, wait_for_profiles, lookup_class_hidr, salinity_crs, cached_stage, force_rerun, write_artifact
+from commons import trace, traced
+from commons.spatial_index import hidrogeology_file
+from data_processing.cleaning import clean_salinity
+from data_processing.ingestion import ingest_salinity
+from data_processing.imputation import spatial_impute
+from data_processing.terciles import fit_terciles, plot_terciles
 
 
+def ingestion_mode() -> str:
+    """Salinity ingestion mode, the `SALINITY_INGESTION` environment variable overrides the configured one."""
+    return os.environ.get('SALINITY_INGESTION', config.ingestion['mode'])
+
+def salinity_url() -> str:
+    """URL of the salinity dataset for the ingestion mode, the `SALINITY_URL` and `SALINITY_SODA_URL`
+    environment variables override the configured sources."""
+    if ingestion_mode()=='paginated':
+        return os.environ.get('SALINITY_SODA_URL', config.sources['salinity_soda'])
+    return os.environ.get('SALINITY_URL', config.sources['salinity'])
+
+@traced
+@cached_stage(config_values=lambda: (ingestion_mode(), salinity_url()), max_age=config.cache['source_max_age'])
 def get_salinity() -> pd.DataFrame:
-    """Fetch the salinity dataset from the specified URL and save it locally."""
+    """Fetch the salinity dataset from the specified URL and save it locally.
+    In 'paginated' ingestion mode the dataset is fetched from the SODA API in concurrent, resumable pages."""
     try:
-        salinity = pd.read_csv(
-            os.environ.get(
-                'SALINITY_URL',
-                "https://datos-abiertos-igac-igac-oit.hub.arcgis.com/api/download/v1/items/182ec73875ff4d9c8c24f7c1630acf58/csv?layers=0"
-            )
-        )
-        salinity.to_csv(os.path.join(config.path['raw_data'], '_Salinidad_Guajira.csv'), index=0)
+        if ingestion_mode()=='paginated':
+            salinity = ingest_salinity(salinity_url())
+        else:
+            salinity = pd.read_csv(salinity_url())
+        write_artifact(salinity, '_Salinidad_Guajira', config.path['raw_data'])
         return salinity
     except Exception as e:
         raise e
 
+@traced
+@cached_stage(config_values=lambda: (
+    config.salinity_data_dictionary, config.salinity_exclude_cols,
+    config.salinity_missing_cols, config.salinity_group_use_aliases
+))
 def select_salinity_cols(salinity: pd.DataFrame) -> pd.DataFrame:
     """Select and clean the relevant columns from the salinity dataset based on the configuration.
-    This function performs several cleaning steps, including:
-    - Removing non-numeric characters from numeric columns and converting them to the appropriate data types.
-    - Replacing zero values in numeric columns with NaN to indicate missing data.
+    This function applies the cleaning plan compiled from `config.data`, which performs:
     - Dropping columns that are excluded or have too many missing values.
+    - Removing non-numeric characters from numeric columns and converting them to the appropriate data types in a single pass.
+    - Replacing blank values with NaN to indicate missing data.
+    - Excluding records with 5 or more missing values.
     - Standardizing categories in the 'Uso_del_Su' column based on defined aliases.
     Args:
         salinity (pd.DataFrame): The raw salinity dataset to be processed.
     Returns:
         pd.DataFrame: The cleaned and pre-curated salinity dataset.
     """
-    for col, typ in config.salinity_data_dictionary.items():
-        if typ in [float, int]:
-            salinity[col] = salinity[col].astype(str).str.replace('[^a-zA-Z0-9.,]', '', regex=True)
-            if typ==float:
-                salinity[col] = salinity[col].str.replace(',', '.', regex=True).str.replace('[a-zA-Z]+', '', regex=True)
-            for i in range(5):
-                salinity[col] = salinity[col].replace(' '*i, np.nan)
-    for col, typ in config.salinity_data_dictionary.items():
-        if typ in [str, 'category']:
-            for i in range(5):
-                salinity[col] = salinity[col].replace(' '*i, np.nan)
-        if typ in [float, int]:
-            salinity.loc[salinity[col]==0, col] = np.nan
-    salinity.drop(config.salinity_exclude_cols, axis=1, inplace=True)
-    salinity.drop(config.salinity_missing_cols, axis=1, inplace=True)
-    #excluding registers with more than 5 mising values
-    salinity = salinity[salinity.isna().sum(axis=1)<5]
-    #standard Uso_del_Su col categories
-    for label, aliases in config.salinity_group_use_aliases.items():
-        salinity['Uso_del_Su'] = salinity['Uso_del_Su'].replace({alias: label for alias in aliases})
-    salinity = salinity.astype({key: value for key, value in config.salinity_data_dictionary.items() if key in salinity.columns})
-    #exporting pre-curated database
-    salinity.to_csv(os.path.join(config.path['precurated_data'], 'salinity_precurated.csv'), index=0)
+    salinity = clean_salinity(salinity)
     return salinity.reset_index(drop=True)
 
+@traced
+@cached_stage(config_values=lambda: (config.salinity_numeric_cols, config.imputation))
 def input_numeric_cols(salinity: pd.DataFrame) -> pd.DataFrame:
-    """Impute missing values in numeric columns of the salinity dataset using KNN imputation.
-    This function selects the numeric columns from the salinity dataset, applies KNN imputation to
-    fill in missing values, and returns a new DataFrame containing the imputed numeric data.
+    """Impute missing values in numeric columns of the salinity dataset.
+    This function selects the numeric columns from the salinity dataset, fills in missing values and returns
+    a new DataFrame containing the imputed numeric data. The method is set in `config.imputation`:
+    - 'knn' applies KNN imputation over all the numeric columns.
+    - 'spatial' averages the values of the geographically nearest records, using KD-trees on the coordinates.
+    - 'auto' applies KNN imputation up to `knn_max_rows` records and the spatial imputation above it.
     Args:
         salinity (pd.DataFrame): The salinity dataset with potential missing values in numeric columns.
     Returns:
         pd.DataFrame: A DataFrame containing the numeric columns with imputed values.
     """
     numeric_inputted_set = salinity[config.salinity_numeric_cols]
-    imputer = KNNImputer(n_neighbors=3)
+    method = config.imputation['method']
+    if method=='spatial' or (method=='auto' and len(numeric_inputted_set)>config.imputation['knn_max_rows']):
+        return spatial_impute(numeric_inputted_set).reset_index(drop=True)
+    imputer = KNNImputer(n_neighbors=config.imputation['n_neighbors'])
     numeric_inputted_set = pd.DataFrame(
         data=imputer.fit_transform(numeric_inputted_set),
         columns=numeric_inputted_set.columns
     )
     return numeric_inputted_set
 
-def join_gepandas(file_path: str) -> pd.DataFrame:
-    """Create a geospatially joined dataset of salinity points and hydrogeologic classes. 
-    This function builds an output file linking salinity locations to their corresponding hydrogeologic classification.
+@traced
+@cached_stage(files=lambda: [hidrogeology_file(), os.path.join(config.path['raw_data'], '_Salinidad_Guajira.zip')])
+def join_gepandas(dataset: pd.DataFrame) -> pd.DataFrame:
+    """Link salinity points to their corresponding hydrogeologic class.
+    The lookup runs against the persisted hydrogeologic spatial index, converting the X, Y
+    coordinates from the salinity layer CRS to the polygon map CRS.
 
     Args:
-        file_path: Destination path where the joined dataset will be saved as a CSV file.
+        dataset (pd.DataFrame): Dataset with the 'X' and 'Y' coordinates of the salinity points.
 
     Returns:
-        pd.DataFrame: The geospatially joined dataset of salinity points and hydrogeologic classes.
+        pd.DataFrame: The 'X', 'Y' and 'class_hidr' of each point, aligned with the dataset index.
     """
-    hidrogeology = gpd.read_file(os.path.join(config.path['raw_data'], 'Mapa_hidrogeologico_polygon.zip'))
-    hidrogeology = hidrogeology[['class_hidr', 'geometry']]
-    hidrology_cats = gpd.read_file(os.path.join(config.path['raw_data'], '_Salinidad_Guajira.zip'))
-    hidrology_cats = hidrology_cats.to_crs(hidrogeology.crs)
-    hidrology_cats = gpd.sjoin(hidrology_cats, hidrogeology, how="left", predicate="within")
-    hidrology_cats = hidrology_cats[['X', 'Y', 'class_hidr']]
-    hidrology_cats.to_csv(file_path, index=0)
+    hidrology_cats = dataset[['X', 'Y']].copy()
+    hidrology_cats['class_hidr'] = lookup_class_hidr(dataset['X'], dataset['Y'], crs=salinity_crs())
     return hidrology_cats
 
 def estimate_terciles(values: pd.Series) -> tuple[float]:
     """Estimate tercile thresholds from a salinity distribution using an alpha distribution fit.
     This function derives two cutoff values that split the input salinity values into three categories.
+    The fit runs on the engine set in `config.terciles`, see `data_processing.terciles.fit_terciles`.
 
     Args:
         values (pd.Series): Series of numeric salinity values used to fit the distribution and compute terciles.
@@ -105,19 +111,25 @@ def estimate_terciles(values: pd.Series) -> tuple[float]:
     Returns:
         tuple[float]: A tuple containing the first and second tercile thresholds.
     """
-    a, b, c = stats.alpha.fit(values)
-    fig = px.histogram(values, nbins=50, opacity=0.6, histnorm='probability density',
-                    title="Histogram with Fitted Normal Distribution")
-    x = np.linspace(min(values), max(values), 100)
-    pdf = stats.alpha.pdf(x, a, b, c)
-    fig.add_trace(go.Scatter(x=x, y=pdf, mode='lines', name='Fitted Distribution'))
-    # Show plot
-    fig.write_html(os.path.join(config.path['curated_data'], 'distribution_aproximation.html'))
-    #tercile calculus
-    q1 = stats.alpha.ppf(1/3, a, b, c)
-    q2 = stats.alpha.ppf(2/3, a, b, c)
-    return q1, q2
+    params = fit_terciles(values)
+    return params['q1'], params['q2']
+
+def plot_distribution(values: pd.Series) -> None:
+    """Write the histogram of the salinity values with the fitted distribution and its terciles when `config.terciles['plot']` is set.
+    It runs outside the memoized stages, so the file is written on a cache hit too, and the fit is read from the tercile cache."""
+    if config.terciles['plot']:
+        plot_terciles(values, fit_terciles(values), os.path.join(config.path['curated_data'], 'distribution_aproximation.html'))
 
+def assign_categories(dataset: pd.DataFrame, q1: float, q2: float) -> pd.DataFrame:
+    """Label the salinity of each record with the tercile thresholds and drop the numeric 'SAL' column."""
+    dataset.loc[(dataset.SAL<q1), 'CATEGORIA_SAL'] = 'SALINIDAD_BAJA'
+    dataset.loc[(dataset.SAL>q1)&(dataset.SAL<q2), 'CATEGORIA_SAL'] = 'SALINIDAD_MEDIA'
+    dataset.loc[(dataset.SAL>q2), 'CATEGORIA_SAL'] = 'SALINIDAD_ALTA'
+    dataset = dataset.drop('SAL', axis=1)
+    return dataset
+
+@traced
+@cached_stage(config_values=lambda: config.terciles)
 def get_salt_categories(dataset: pd.DataFrame) -> pd.DataFrame:
     """Categorize salinity values into three categories based on estimated terciles.
     This function assigns a categorical label to each salinity value in the dataset
@@ -133,20 +145,17 @@ def get_salt_categories(dataset: pd.DataFrame) -> pd.DataFrame:
         and the original 'SAL' column removed.
     """
     q1, q2 = estimate_terciles(dataset['SAL'])
-    dataset.loc[(dataset.SAL<q1), 'CATEGORIA_SAL'] = 'SALINIDAD_BAJA'
-    dataset.loc[(dataset.SAL>q1)&(dataset.SAL<q2), 'CATEGORIA_SAL'] = 'SALINIDAD_MEDIA'
-    dataset.loc[(dataset.SAL>q2), 'CATEGORIA_SAL'] = 'SALINIDAD_ALTA'
-    dataset = dataset.drop('SAL', axis=1)
-    return dataset
+    return assign_categories(dataset, q1, q2)
 
+@traced
 def build_dataset(numeric_inputted_set: pd.DataFrame, salinity: pd.DataFrame) -> pd.DataFrame:
     """Construct the final curated salinity dataset by combining imputed numeric data with categorical data and hydrogeologic classifications.
     This function performs several steps to build the final dataset:
     - It starts with the imputed numeric dataset and adds the relevant categorical columns from the original salinity dataset.
-    - It performs a geospatial join to associate each salinity point with its corresponding hydrogeologic class, using the 'X' and 'Y' coordinates for the join.
+    - It performs a geospatial lookup to associate each salinity point with its corresponding hydrogeologic class, using its 'X' and 'Y' coordinates.
     - It categorizes the salinity values into defined categories based on estimated terciles.
     - It drops columns that are excluded from correlation analysis and filters the dataset to include only records of type 'Pozo'.
-    - Finally, it removes duplicates based on the 'X' and 'Y' coordinates and saves the curated dataset as a CSV file in the designated directory.
+    - Finally, it removes duplicates based on the 'X' and 'Y' coordinates and saves the curated dataset as an artifact in the designated directory.
     Args:
         numeric_inputted_set (pd.DataFrame): The dataset containing imputed numeric values for the salinity data.
         salinity (pd.DataFrame): The original salinity dataset containing categorical columns and coordinates.
@@ -155,19 +164,37 @@ def build_dataset(numeric_inputted_set: pd.DataFrame, salinity: pd.DataFrame) ->
     """
     dataset = numeric_inputted_set.copy()
     dataset[config.salinity_cat_cols] = salinity[config.salinity_cat_cols]
-    file_path = os.path.join(config.path['curated_data'], 'hidrology_cats.csv')
-    hidrology_cats = pd.read_csv(file_path) if os.path.exists(file_path) else join_gepandas(file_path)
-    dataset = dataset.join(hidrology_cats.set_index(['X', 'Y']), on=('X','Y')).dropna(subset=['class_hidr'])
+    dataset['class_hidr'] = join_gepandas(dataset[['X', 'Y']])['class_hidr']
+    dataset = dataset.dropna(subset=['class_hidr'])
+    plot_distribution(dataset['SAL'])
     dataset = get_salt_categories(dataset)
-    dataset.drop(config.salinity_correlation_excludes, axis=1, inplace=True)
+    return finalize_dataset(dataset)
+
+def finalize_dataset(dataset: pd.DataFrame) -> pd.DataFrame:
+    """Keep the model columns of the wells of a labeled dataset and save it as the curated artifact.
+    The columns excluded from the correlation analysis are dropped, only records of type 'Pozo' are kept
+    and duplicated coordinates are removed.
+
+    Args:
+        dataset (pd.DataFrame): Dataset with the imputed numeric columns, the categorical columns,
+            'class_hidr' and 'CATEGORIA_SAL'.
+
+    Returns:
+        pd.DataFrame: The curated salinity dataset.
+    """
+    dataset = dataset.drop(config.salinity_correlation_excludes, axis=1)
     dataset = dataset[dataset.Tipo_de_Ca=='Pozo']
     dataset = dataset.drop(['T_Seco', 'Tipo_de_Ca'], axis=1)
     dataset = dataset.drop_duplicates(['X', 'Y'])
-    dataset.to_csv(os.path.join(config.path['curated_data'], 'salinity_curated.csv'), index=0)
+    write_artifact(dataset, 'salinity_curated', config.path['curated_data'])
     return dataset
 
-def process_data():
+@traced
+def process_data(rerun_from: str=None):
     """Execute the full data processing pipeline for the salinity dataset.
+    Every stage is memoized on its inputs and configuration, so unchanged stages are loaded from the cache.
+    The profiling reports are generated in background processes and the function waits for them before returning.
+    The time, CPU, memory and rows of every stage are recorded as spans of the run report, see `commons.instrumentation`.
     This function orchestrates the entire data processing workflow, which includes:
     - Fetching the raw salinity dataset from the specified URL.
     - Generating a profiling report for the raw dataset and saving it.
@@ -175,14 +202,20 @@ def process_data():
     - Imputing missing values in the numeric columns of the pre-curated dataset.
     - Building the final curated dataset by combining the imputed numeric data with categorical data and hydrogeologic classifications, and generating a profiling report for the final curated dataset.
     Args:
-        None
+        rerun_from (str): Name of a stage to run again along with every stage after it, ignoring the cache.
     Returns:
         None
     """
+    if rerun_from:
+        force_rerun(rerun_from)
     salinity = get_salinity()
-    _ = profile_dataset(salinity, name='raw-salinity_report', save=True)
+    _ = profile_dataset(salinity, name='raw-salinity_report', save=True, stage='raw')
     salinity_ = select_salinity_cols(salinity)
-    _ = profile_dataset(salinity_, name='precurated-salinity_report', save=True)
+    #exporting pre-curated database, also when the stage is loaded from the cache
+    write_artifact(salinity_, 'salinity_precurated', config.path['precurated_data'])
+    _ = profile_dataset(salinity_, name='precurated-salinity_report', save=True, stage='precurated')
     numeric_inputted_set = input_numeric_cols(salinity_)
     dataset = build_dataset(numeric_inputted_set, salinity_)
-    _ = profile_dataset(dataset, name='curated-salinity_report.html', save=True)
\ No newline at end of file
+    _ = profile_dataset(dataset, name='curated-salinity_report.html', save=True, stage='curated')
+    with trace('wait_for_profiles'):
+        wait_for_profiles()
\ No newline at end of file
@@ -0,0 +1,222 @@
+import os, json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import config
+
+import pandas as pd, numpy as np
+import plotly.graph_objects as go
+from scipy import stats, optimize
+
+from commons import fingerprint
+
+#fits kept in the tercile cache, the most recent one is the warm start of the next fit
+CACHE_ENTRIES = 16
+
+
+def stratified_sample(values: np.ndarray, size: int, seed: int=None) -> np.ndarray:
+    """Draw one value from each of `size` equally populated strata of the sorted values,
+    so the sample follows the distribution tails more closely than a simple random sample."""
+    values = np.sort(values)
+    if len(values)<=size:
+        return values
+    bounds = np.linspace(0, len(values), size + 1).astype(int)
+    rng = np.random.default_rng(seed)
+    return values[bounds[:-1] + (rng.random(size)*(bounds[1:] - bounds[:-1])).astype(int)]
+
+def binned_counts(values: np.ndarray, n_bins: int) -> tuple:
+    """Bin the values on their quantiles, so every bin holds about the same number of values.
+    Returns the bin edges and the count of each bin."""
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, n_bins + 1)))
+    if len(edges)<2:
+        edges = np.array([edges[0] - 0.5, edges[0] + 0.5])
+    return edges, np.histogram(values, edges)[0]
+
+def initial_guesses(values: np.ndarray) -> list:
+    """Starting (a, loc, scale) candidates for a few locations below the smallest value.
+    For an alpha distribution scale/(x - loc) is normal with mean a and unit deviation, so for each
+    location the shape and scale are read from the median and interquartile range of 1/(x - loc)."""
+    low, spread = values.min(), (np.median(values) - values.min()) or 1.0
+    guesses = []
+    for factor in (0.01, 0.1, 0.3, 1, 3):
+        loc = low - spread*factor
+        q25, q50, q75 = np.percentile(1/(values - loc), [25, 50, 75])
+        scale = 1.349/(q75 - q25) if q75>q25 else spread
+        guesses.append((max(q50*scale, 1e-3), loc, scale))
+    return guesses
+
+def _unpack(theta: np.ndarray, low: float) -> tuple:
+    #the shape and scale are positive and loc stays below the smallest value
+    return np.exp(theta[0]), low - np.exp(theta[1]), np.exp(theta[2])
+
+def _pack(params: tuple, low: float, spread: float) -> np.ndarray:
+    a, loc, scale = params
+    return np.log([max(a, 1e-6), max(low - loc, 1e-6*spread), max(scale, 1e-6*spread)])
+
+def _binned_nll(theta: np.ndarray, edges: np.ndarray, counts: np.ndarray) -> float:
+    a, loc, scale = _unpack(theta, edges[0])
+    #the outer bins are open, so the likelihood does not depend on the range of the values
+    cdf = np.concatenate([[0.0], stats.alpha.cdf(edges[1:-1], a, loc, scale), [1.0]])
+    return -np.sum(counts*np.log(np.maximum(np.diff(cdf), 1e-300)))
+
+def _best(fits: list, scores: list) -> tuple:
+    #the lowest score wins, an earlier fit is kept unless a later one is clearly better
+    best = 0
+    for i, score in enumerate(scores):
+        if np.isfinite(score) and (not np.isfinite(scores[best]) or score<scores[best] - 1e-9*max(abs(scores[best]), 1.0)):
+            best = i
+    return fits[best]
+
+def fit_binned(edges: np.ndarray, counts: np.ndarray, starts: list) -> tuple:
+    """Maximum likelihood fit of an alpha distribution to binned values.
+    The optimizer runs from every candidate and the fit with the highest final likelihood is kept.
+
+    Args:
+        edges (np.ndarray): Bin edges.
+        counts (np.ndarray): Number of values in each bin.
+        starts (list): Candidate (a, loc, scale) starting parameters.
+
+    Returns:
+        tuple: The fitted (a, loc, scale).
+    """
+    spread = edges[-1] - edges[0] or 1.0
+    results = [optimize.minimize(_binned_nll, _pack(start, edges[0], spread), args=(edges, counts), method='Nelder-Mead',
+                                 options={'xatol': 1e-8, 'fatol': 1e-8, 'maxiter': 4000}) for start in starts]
+    result = _best(results, [result.fun for result in results])
+    return tuple(float(param) for param in _unpack(result.x, edges[0]))
+
+def fit_values(values: np.ndarray, starts: list) -> tuple:
+    """Maximum likelihood fit of an alpha distribution to the values from every candidate start, keeping the most likely fit."""
+    fits = [tuple(float(param) for param in stats.alpha.fit(values, start[0], loc=start[1], scale=start[2])) for start in starts]
+    return _best(fits, [-np.sum(stats.alpha.logpdf(values, *fit)) for fit in fits])
+
+def _fit(data, method: str, starts: list) -> tuple:
+    return fit_binned(*data, starts) if method=='binned' else fit_values(data, starts)
+
+def _fit_data(values: np.ndarray, settings: dict):
+    """Data the fit runs on: the bins, a stratified subsample or every value."""
+    if settings['method']=='binned':
+        return binned_counts(values, settings['n_bins'])
+    if settings['method']=='subsample':
+        return stratified_sample(values, settings['sample_size'], settings['random_state'])
+    if settings['method']=='full':
+        return values
+    raise ValueError(f"Unknown tercile fit method {settings['method']}, use 'binned', 'subsample' or 'full'")
+
+def _thresholds(params: tuple) -> tuple:
+    return tuple(float(q) for q in stats.alpha.ppf([1/3, 2/3], *params))
+
+def _bootstrap_task(data, method: str, params: tuple, seeds: list) -> list:
+    """Refit the resamples of the fit data drawn with each seed and return their thresholds."""
+    thresholds = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        if method=='binned':
+            edges, counts = data
+            resample = edges, rng.multinomial(counts.sum(), counts/counts.sum())
+        else:
+            resample = rng.choice(data, len(data))
+        thresholds.append(_thresholds(_fit(resample, method, [params])))
+    return thresholds
+
+def bootstrap_intervals(data, method: str, params: tuple, n_resamples: int, confidence: float,
+                        n_jobs: int=None, random_state: int=None) -> dict:
+    """Percentile bootstrap confidence intervals of the tercile thresholds.
+    Binned data are resampled from the multinomial distribution of the bin counts and values with
+    replacement. Each resample is refitted warm-started from the fitted parameters, in parallel worker processes.
+
+    Args:
+        data: Data of the fit, the bin edges and counts or the fitted values.
+        method (str): Fit method, 'binned', 'subsample' or 'full'.
+        params (tuple): Fitted (a, loc, scale).
+        n_resamples (int): Number of bootstrap resamples.
+        confidence (float): Confidence level of the intervals, e.g. 0.95.
+        n_jobs (int): Number of worker processes, 1 runs in the current process, None uses all the available cores.
+        random_state (int): Seed of the resamples.
+
+    Returns:
+        dict: The 'q1_ci' and 'q2_ci' intervals as [low, high].
+    """
+    seeds = np.random.SeedSequence(random_state).spawn(n_resamples)
+    n_jobs = min(n_jobs or os.cpu_count() or 1, n_resamples)
+    chunks = [seeds[i::n_jobs] for i in range(n_jobs)]
+    if n_jobs==1:
+        thresholds = _bootstrap_task(data, method, params, seeds)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_bootstrap_task, data, method, params, chunk) for chunk in chunks]
+            thresholds = [item for future in futures for item in future.result()]
+    tail = (1 - confidence)/2*100
+    low, high = np.percentile(np.array(thresholds), [tail, 100 - tail], axis=0)
+    return {'q1_ci': [float(low[0]), float(high[0])], 'q2_ci': [float(low[1]), float(high[1])]}
+
+def _cache_file() -> str:
+    return os.path.join(config.path['cache'], 'terciles.json')
+
+def _read_cache() -> dict:
+    if not config.cache['enabled'] or not os.path.exists(_cache_file()):
+        return {'last': None, 'fits': {}}
+    with open(_cache_file()) as f:
+        return json.load(f)
+
+def _write_cache(cache: dict) -> None:
+    if not config.cache['enabled']:
+        return
+    os.makedirs(config.path['cache'], exist_ok=True)
+    with open(_cache_file(), 'w') as f:
+        json.dump(cache, f, indent=2)
+
+def fit_terciles(values: pd.Series) -> dict:
+    """Fit an alpha distribution to the salinity values and derive its tercile thresholds.
+    The fit follows `config.terciles`: on quantile bins of the values ('binned'), on a stratified
+    subsample ('subsample') or on every value ('full'). The optimizer runs from quick estimates on a small
+    stratified sample and, with `warm_start`, also from the parameters of the last fit; the most likely
+    fit is kept, and the warm start only wins when it is clearly more likely, so the result does not
+    depend on the cache. Fits are cached in `output/cache/terciles.json` on a fingerprint of the values
+    and the fit settings.
+
+    Args:
+        values (pd.Series): Series of numeric salinity values.
+
+    Returns:
+        dict: The fitted parameters 'a', 'loc' and 'scale', the thresholds 'q1' and 'q2', the fit
+        'method' and, with `bootstrap` resamples, the 'q1_ci' and 'q2_ci' confidence intervals.
+    """
+    settings = config.terciles
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    fit_settings = ('method', 'sample_size', 'n_bins', 'start_sample', 'warm_start', 'bootstrap', 'confidence', 'random_state')
+    key = fingerprint(values, {name: settings[name] for name in fit_settings})
+    cache = _read_cache()
+    if key in cache['fits']:
+        return cache['fits'][key]
+    sample = stratified_sample(values, settings['start_sample'], settings['random_state'])
+    starts = initial_guesses(sample) + [stats.alpha.fit(sample)]
+    if settings['warm_start'] and cache['last'] in cache['fits']:
+        last = cache['fits'][cache['last']]
+        starts.append((last['a'], last['loc'], last['scale']))
+    data = _fit_data(values, settings)
+    a, loc, scale = _fit(data, settings['method'], starts)
+    q1, q2 = _thresholds((a, loc, scale))
+    params = {'a': a, 'loc': loc, 'scale': scale, 'q1': q1, 'q2': q2, 'method': settings['method']}
+    if settings['bootstrap']:
+        params.update(bootstrap_intervals(data, settings['method'], (a, loc, scale), settings['bootstrap'],
+                                          settings['confidence'], settings['n_jobs'], settings['random_state']))
+    cache['fits'] = OrderedDict(list(cache['fits'].items())[-(CACHE_ENTRIES - 1):] + [(key, params)])
+    cache['last'] = key
+    _write_cache(cache)
+    return params
+
+def plot_terciles(values: pd.Series, params: dict, file_path: str) -> None:
+    """Write the histogram of the salinity values with the fitted distribution and its tercile thresholds as HTML.
+    The histogram is computed before plotting, so the file size does not grow with the number of values."""
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    density, edges = np.histogram(values, bins=50, density=True)
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:])/2, y=density, width=np.diff(edges), opacity=0.6, name='SAL'))
+    fig.update_layout(title='Histogram with Fitted Normal Distribution', bargap=0)
+    x = np.linspace(values.min(), values.max(), 100)
+    pdf = stats.alpha.pdf(x, params['a'], params['loc'], params['scale'])
+    fig.add_trace(go.Scatter(x=x, y=pdf, mode='lines', name='Fitted Distribution'))
+    for name in ('q1', 'q2'):
+        fig.add_vline(x=params[name], line_dash='dash', annotation_text=name)
+    fig.write_html(file_path)
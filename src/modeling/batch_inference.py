@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd, numpy as np
+
+import config
+from commons import load_spatial_index, lookup_class_hidr, salinity_crs
+from modeling.registry import load_model
+
+#state loaded once per worker process by _init_worker
+_worker = {}
+
+
+def build_grid(bbox: tuple[float], cell_size: float) -> dict:
+    """Build the coordinate grid that covers a bounding box.
+    The grid has as many cells as needed to cover each side, so the last row and column may extend past the box.
+    Cells are laid out as a north-up raster: row 0 is the northernmost row and column 0 the
+    westernmost column. Only the cell center axes are stored, the full coordinate set is derived
+    chunk by chunk to keep memory bounded.
+
+    Args:
+        bbox (tuple[float]): Bounding box as (xmin, ymin, xmax, ymax) in the salinity coordinate system.
+        cell_size (float): Side of the square cells, in the units of the coordinate system.
+
+    Returns:
+        dict: Grid definition with the cell center axes 'x' and 'y', the raster 'shape', the 'bbox' and the 'cell_size'.
+    """
+    xmin, ymin, xmax, ymax = bbox
+    if cell_size <= 0 or xmax <= xmin or ymax <= ymin:
+        raise ValueError(f'Invalid grid definition: bbox={bbox}, cell_size={cell_size}')
+    #the cell counts are rounded up on the integers, a float step can add or drop the last cell
+    n_cols = int(np.ceil((xmax - xmin)/cell_size - 1e-9))
+    n_rows = int(np.ceil((ymax - ymin)/cell_size - 1e-9))
+    x = xmin + (np.arange(n_cols) + 0.5)*cell_size
+    y = ymax - (np.arange(n_rows) + 0.5)*cell_size
+    return {'x': x, 'y': y, 'shape': (len(y), len(x)), 'bbox': tuple(bbox), 'cell_size': cell_size}
+
+def cell_coordinates(grid: dict, start: int, stop: int) -> tuple[np.ndarray]:
+    """Compute the X, Y coordinates of a contiguous range of flattened grid cells.
+
+    Args:
+        grid (dict): Grid definition returned by `build_grid`.
+        start (int): First flattened cell index (row-major order).
+        stop (int): Flattened cell index where the range ends (excluded).
+
+    Returns:
+        tuple[np.ndarray]: Arrays with the X and Y coordinates of the cells.
+    """
+    idx = np.arange(start, stop)
+    rows, cols = np.divmod(idx, grid['shape'][1])
+    return grid['x'][cols], grid['y'][rows]
+
+def _init_worker(model_name: str, crs) -> None:
+    """Load the pipeline and the hydrogeologic spatial index once per worker process."""
+    _worker['model'] = load_model(model_name)
+    load_spatial_index()
+    _worker['crs'] = crs
+
+def _predict_chunk(grid: dict, start: int, stop: int, mask_outside: bool) -> tuple:
+    """Predict the salinity class code and its probability for a range of grid cells."""
+    xs, ys = cell_coordinates(grid, start, stop)
+    class_hidr = lookup_class_hidr(xs, ys, crs=_worker['crs'])
+    inside = pd.notna(class_hidr)
+    if not mask_outside:
+        class_hidr[~inside] = 'MISSING'
+        inside[:] = True
+    codes = np.full(stop - start, config.prediction_grid['nodata'], dtype=np.uint8)
+    probability = np.full(stop - start, np.nan, dtype=np.float32)
+    if inside.any():
+        X = pd.DataFrame({'X': xs[inside], 'Y': ys[inside], 'class_hidr': class_hidr[inside]})
+        probas_ = _worker['model'].predict_proba(X)
+        best = probas_.argmax(axis=1)
+        codes[inside] = best
+        probability[inside] = probas_[np.arange(len(best)), best]
+    return start, codes, probability
+
+def predict_grid(bbox: tuple[float], cell_size: float, model_name: str='Voting', crs=None,
+                 chunk_size: int=None, n_jobs: int=None, mask_outside: bool=True, save: bool=True) -> dict:
+    """Predict the salinity category over a regular grid that covers a bounding box.
+    The grid is split in chunks of flattened cells that are predicted in a process pool. Each worker
+    loads the pipeline and the hydrogeologic spatial index once, derives the coordinates of its chunk,
+    assigns `class_hidr` and runs a single vectorized `predict_proba` call over the chunk.
+
+    Args:
+        bbox (tuple[float]): Bounding box as (xmin, ymin, xmax, ymax) in the salinity coordinate system.
+        cell_size (float): Side of the square cells, in the units of the coordinate system.
+        model_name (str): Name of the pipeline in the model registry.
+        crs: Coordinate reference system of the bounding box, by default the one of the salinity points layer.
+        chunk_size (int): Number of cells per worker task, by default `config.prediction_grid['chunk_size']`.
+        n_jobs (int): Number of worker processes, 1 runs in the current process. By default `config.prediction_grid['n_jobs']`.
+        mask_outside (bool): Whether cells outside the hydrogeologic map are left as nodata instead of
+            being predicted with the 'MISSING' class.
+        save (bool): Whether to save the raster as a compressed `.npz` file in the predictions directory.
+
+    Returns:
+        dict: Raster with the 'class' codes (uint8, nodata for masked cells), the predicted class
+        'probability' (float32), the 'labels' of each code and the grid definition.
+    """
+    crs = salinity_crs() if crs is None else crs
+    chunk_size = chunk_size or config.prediction_grid['chunk_size']
+    n_jobs = n_jobs if n_jobs is not None else config.prediction_grid['n_jobs']
+    grid = build_grid(bbox, cell_size)
+    #building the spatial index here, so the workers only load it
+    load_spatial_index()
+    n_cells = grid['shape'][0]*grid['shape'][1]
+    codes = np.empty(n_cells, dtype=np.uint8)
+    probability = np.empty(n_cells, dtype=np.float32)
+    chunks = [(start, min(start + chunk_size, n_cells)) for start in range(0, n_cells, chunk_size)]
+    if n_jobs == 1:
+        _init_worker(model_name, crs)
+        results = (_predict_chunk(grid, start, stop, mask_outside) for start, stop in chunks)
+        for start, chunk_codes, chunk_probability in results:
+            codes[start:start + len(chunk_codes)] = chunk_codes
+            probability[start:start + len(chunk_codes)] = chunk_probability
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(model_name, crs)) as pool:
+            futures = [pool.submit(_predict_chunk, grid, start, stop, mask_outside) for start, stop in chunks]
+            for future in futures:
+                start, chunk_codes, chunk_probability = future.result()
+                codes[start:start + len(chunk_codes)] = chunk_codes
+                probability[start:start + len(chunk_codes)] = chunk_probability
+    #translating the pipeline codes to salinity categories
+    le = load_model('LabelEncoder')
+    raster = {
+        'class': codes.reshape(grid['shape']), 'probability': probability.reshape(grid['shape']),
+        'labels': np.asarray(le.classes_, dtype=str), 'x': grid['x'], 'y': grid['y'],
+        'bbox': np.asarray(grid['bbox']), 'cell_size': grid['cell_size'],
+        'nodata': config.prediction_grid['nodata']
+    }
+    if save:
+        np.savez_compressed(os.path.join(config.path['predictions'], f'{model_name}_grid.npz'), **raster)
+    return raster
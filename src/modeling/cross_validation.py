@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd, numpy as np
 import plotly.graph_objects as go, plotly.subplots as sp
 from sklearn.base import clone
@@ -6,6 +7,9 @@ from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import label_binarize
 from sklearn.metrics import f1_score, balanced_accuracy_score, roc_auc_score, roc_curve, auc
 
+import config
+from commons import traced, record_span, snapshot, elapsed, peak_rss_mb, read_artifact, write_artifact
+
 
 
 def add_roc_traces(fig: go.Figure, n_classes: int, i: int, y_bin: list, test: list, probas_: list) -> go.Figure:
@@ -79,24 +83,120 @@ def plot_metrics(results: pd.DataFrame) -> go.Figure:
     fig.update_yaxes(tickfont=dict(size=10))
     return fig
 
-def cross_validate(base_model,  X: pd.DataFrame, y: pd.DataFrame, folds: int=5):
-    classes = np.unique(y)
-    y_bin = label_binarize(y, classes=classes)
-    n_classes = y_bin.shape[1]
-    cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=42)
+def interpolate_roc(y_bin: np.ndarray, probas_: np.ndarray, fpr_grid: np.ndarray) -> tuple:
+    """Interpolate the one-vs-rest ROC curve of each class of a fold onto a fixed FPR grid.
+    Args:
+        y_bin (np.ndarray): Binarized target of the fold.
+        probas_ (np.ndarray): Predicted probabilities of each class.
+        fpr_grid (np.ndarray): False positive rates where the curves are evaluated.
+    Returns:
+        tuple: The TPR of each class on the grid, shape (classes, grid points), and the AUC of each class.
+    """
+    tprs, aucs = [], []
+    for j in range(y_bin.shape[1]):
+        fpr, tpr, _ = roc_curve(y_bin[:, j], probas_[:, j])
+        tprs.append(np.interp(fpr_grid, fpr, tpr))
+        tprs[-1][0] = 0.0
+        aucs.append(auc(fpr, tpr))
+    return np.array(tprs), np.array(aucs)
+
+def summarize_roc(tprs: list, fpr_grid: np.ndarray) -> pd.DataFrame:
+    """Aggregate the interpolated ROC curves of the folds as the mean and standard deviation of the TPR per class."""
+    tprs = np.stack(tprs)
+    n_classes = tprs.shape[1]
+    return pd.DataFrame({
+        'class': np.repeat(np.arange(n_classes), len(fpr_grid)),
+        'fpr': np.tile(fpr_grid, n_classes),
+        'tpr_mean': tprs.mean(axis=0).ravel(),
+        'tpr_std': tprs.std(axis=0).ravel()
+    })
+
+def plot_roc_summary(roc_curves: pd.DataFrame, fold_metrics: pd.DataFrame) -> go.Figure:
+    """Plot the mean ROC curve of each class with a band of one standard deviation across the folds."""
+    roc = go.Figure()
+    for j, curve in roc_curves.groupby('class'):
+        aucs = fold_metrics[f'AUC_clase_{j}']
+        upper = np.minimum(curve.tpr_mean + curve.tpr_std, 1)
+        lower = np.maximum(curve.tpr_mean - curve.tpr_std, 0)
+        # Banda de ±1 desviación estándar
+        roc.add_trace(go.Scatter(
+            x=np.concatenate([curve.fpr, curve.fpr[::-1]]), y=np.concatenate([upper, lower[::-1]]),
+            fill='toself', opacity=0.2, line=dict(width=0), hoverinfo='skip', showlegend=False, legendgroup=str(j)
+        ))
+        roc.add_trace(go.Scatter(
+            x=curve.fpr, y=curve.tpr_mean, mode='lines', legendgroup=str(j),
+            name=f'Clase {j} (AUC={aucs.mean():.2f} ± {aucs.std(ddof=0):.2f})'
+        ))
+    roc = add_roc_layout(roc)
+    roc.update_layout(legend_title="Curva media por clase")
+    return roc
+
+def max_workers(n_jobs: int):
+    """Number of worker processes of a ProcessPoolExecutor for `n_jobs`, None (every core) for None or -1."""
+    return None if n_jobs in (None, -1) else n_jobs
 
+def _fit_fold(model, X_train: pd.DataFrame, y_train: pd.Series, X_test: pd.DataFrame) -> tuple:
+    start = snapshot()
+    model.fit(X_train, y_train)
+    fit, start = elapsed(start), snapshot()
+    probas_, preds = model.predict_proba(X_test), model.predict(X_test)
+    return probas_, preds, _fold_cost(fit, elapsed(start), X_train, X_test)
+
+def _fold_cost(fit: dict, predict: dict, X_train, X_test) -> dict:
+    """Cost of fitting and predicting a fold, measured in the process that ran it."""
+    return {
+        'rows_train': len(X_train), 'rows_test': len(X_test),
+        'fit_wall_seconds': fit['wall_seconds'], 'fit_cpu_seconds': fit['cpu_seconds'],
+        'predict_wall_seconds': predict['wall_seconds'], 'predict_cpu_seconds': predict['cpu_seconds'],
+        'worker_pid': os.getpid(), 'worker_peak_rss_mb': peak_rss_mb()
+    }
+
+def _record_folds(name: str, fold_results: list) -> None:
+    for i, (_, _, cost) in enumerate(fold_results):
+        record_span('fold', model=name, fold=i+1, **cost)
+
+def _fit_model(model, X: pd.DataFrame, y: pd.Series):
+    return model.fit(X, y)
+
+def prepare_fold(preprocess, X_train: pd.DataFrame, y_train: pd.Series, X_test: pd.DataFrame) -> tuple:
+    """Fit the preprocessing steps on a training fold, the same way a pipeline fit does.
+    Transformers are fitted on the training data and applied to the test data, samplers only
+    resample the training data.
+    """
+    preprocess = clone(preprocess)
+    for _, step in preprocess.steps:
+        if hasattr(step, 'fit_resample'):
+            X_train, y_train = step.fit_resample(X_train, y_train)
+        else:
+            X_train = step.fit_transform(X_train, y_train)
+            X_test = step.transform(X_test)
+    return X_train, y_train, X_test
+
+# Matrices de los folds compartidas en modo lectura con los procesos de trabajo
+_shared_folds = []
+
+def init_shared_folds(folds: list) -> None:
+    """Share the fold matrices returned by `prepare_fold` with the current process, e.g. as a pool initializer."""
+    _shared_folds[:] = folds
+
+def shared_fold(i: int) -> tuple:
+    """Training features, training target and test features of the i-th shared fold."""
+    return _shared_folds[i]
+
+def _fit_cached_fold(name: str, model, i: int) -> tuple:
+    X_train, y_train, X_test = shared_fold(i)
+    return (name, i) + _fit_fold(model, X_train, y_train, X_test)
+
+def _evaluate_folds(splits: list, y: pd.Series, y_bin: np.ndarray, n_classes: int, fold_results: list, report: str='full') -> tuple:
     # Almacenar métricas
     metrics = []
 
-    # Figura interactiva
-    roc = go.Figure()
+    # Figura interactiva, o curvas interpoladas en el modo compacto
+    roc = go.Figure() if report=='full' else None
+    fpr_grid = np.linspace(0, 1, config.reporting['fpr_points'])
+    tprs = []
 
-    for i, (train, test) in enumerate(cv.split(X, y)):
-        model = clone(base_model)
-        model.fit(X.iloc[train], y.iloc[train])
-        probas_ = model.predict_proba(X.iloc[test])
-        preds = model.predict(X.iloc[test])
-        
+    for i, ((train, test), (probas_, preds, _)) in enumerate(zip(splits, fold_results)):
         # --- Métricas ---
         f1_w = f1_score(y.iloc[test], preds, average="weighted")
         bal_acc = balanced_accuracy_score(y.iloc[test], preds)
@@ -104,16 +204,210 @@ def cross_validate(base_model,  X: pd.DataFrame, y: pd.DataFrame, folds: int=5):
         
         metrics.append([i+1, f1_w, bal_acc, roc_auc_w])
         
-        roc = add_roc_traces(roc, n_classes, i, y_bin, test, probas_)
+        if report=='full':
+            roc = add_roc_traces(roc, n_classes, i, y_bin, test, probas_)
+        else:
+            fold_tprs, fold_aucs = interpolate_roc(y_bin[test], probas_, fpr_grid)
+            tprs.append(fold_tprs)
+            metrics[-1].extend(fold_aucs)
 
-    roc = add_roc_layout(roc)
-    model = clone(base_model)
-    model.fit(X, y)
     # --- Resultados en tabla ---
-    df_results = pd.DataFrame(metrics, columns=["Fold", "F1_weighted", "Balanced_accuracy", "ROC_AUC_OVR_Weighted"])
+    columns = ["Fold", "F1_weighted", "Balanced_accuracy", "ROC_AUC_OVR_Weighted"]
+    if report!='full':
+        return summarize_roc(tprs, fpr_grid), pd.DataFrame(metrics, columns=columns + [f'AUC_clase_{j}' for j in range(n_classes)])
+    roc = add_roc_layout(roc)
+    df_results = pd.DataFrame(metrics, columns=columns)
     violin = plot_metrics(df_results)
+    return roc, violin
+
+def _cross_validate(base_model, X: pd.DataFrame, y: pd.DataFrame, folds: int, n_jobs: int, report: str) -> tuple:
+    classes = np.unique(y)
+    y_bin = label_binarize(y, classes=classes)
+    n_classes = y_bin.shape[1]
+    cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=42)
+    splits = list(cv.split(X, y))
+
+    if n_jobs == 1:
+        fold_results = [
+            _fit_fold(clone(base_model), X.iloc[train], y.iloc[train], X.iloc[test]) for train, test in splits
+        ]
+        model = _fit_model(clone(base_model), X, y)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers(n_jobs)) as pool:
+            futures = [
+                pool.submit(_fit_fold, clone(base_model), X.iloc[train], y.iloc[train], X.iloc[test])
+                for train, test in splits
+            ]
+            refit = pool.submit(_fit_model, clone(base_model), X, y)
+            fold_results = [future.result() for future in futures]
+            model = refit.result()
+
+    #folds are reported under the name of the classifier, the last step of a pipeline
+    _record_folds(type(base_model.steps[-1][1] if hasattr(base_model, 'steps') else base_model).__name__, fold_results)
+    roc, violin = _evaluate_folds(splits, y, y_bin, n_classes, fold_results, report)
     return roc, violin, model
 
+@traced
+def cross_validate(base_model,  X: pd.DataFrame, y: pd.DataFrame, folds: int=5, n_jobs: int=1):
+    """Evaluate a model with stratified k-fold cross-validation and refit it on the full dataset.
+    Args:
+        base_model: Unfitted estimator or pipeline to evaluate.
+        X (pd.DataFrame): Features.
+        y (pd.DataFrame): Encoded target.
+        folds (int): Number of stratified folds.
+        n_jobs (int): Number of worker processes used to fit the folds and the final model in parallel,
+            1 runs sequentially and -1 or None uses all the available cores.
+    Returns:
+        tuple: The ROC figure with the curve of every fold and class, the violin figure of the fold metrics and the refitted model.
+    """
+    return _cross_validate(base_model, X, y, folds, n_jobs, 'full')
+
+@traced
+def cross_validate_compact(base_model,  X: pd.DataFrame, y: pd.DataFrame, folds: int=5, n_jobs: int=1):
+    """Cross-validate a model as `cross_validate` without building any figure.
+    The ROC curves are interpolated onto a fixed FPR grid of `config.reporting['fpr_points']` points and
+    aggregated per class. The results are kept with `save_cv_metrics` and the figures rendered on demand
+    from the metrics store with `write_cv_report`.
+    Args:
+        base_model: Unfitted estimator or pipeline to evaluate.
+        X (pd.DataFrame): Features.
+        y (pd.DataFrame): Encoded target.
+        folds (int): Number of stratified folds.
+        n_jobs (int): Number of worker processes, as in `cross_validate`.
+    Returns:
+        tuple: The mean ± std ROC curves per class, the fold metrics with the AUC of each class and the refitted model.
+    """
+    return _cross_validate(base_model, X, y, folds, n_jobs, 'compact')
+
+def _cross_validate_models(preprocess, models: dict, X: pd.DataFrame, y: pd.DataFrame, folds: int, n_jobs: int,
+                           report: str) -> dict:
+    classes = np.unique(y)
+    y_bin = label_binarize(y, classes=classes)
+    n_classes = y_bin.shape[1]
+    cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=42)
+    splits = list(cv.split(X, y))
+    pipelines = dict()
+    for name, clf in models.items():
+        pipelines[name] = clone(preprocess)
+        pipelines[name].steps.append(('clf', clone(clf)))
+
+    fold_results = {name: [None]*len(splits) for name in models}
+    if n_jobs == 1:
+        fold_data = [prepare_fold(preprocess, X.iloc[train], y.iloc[train], X.iloc[test]) for train, test in splits]
+        init_shared_folds(fold_data)
+        for name, clf in models.items():
+            for i in range(len(splits)):
+                fold_results[name][i] = _fit_cached_fold(name, clone(clf), i)[2:]
+        refits = {name: _fit_model(pipeline, X, y) for name, pipeline in pipelines.items()}
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers(n_jobs)) as pool:
+            futures = [
+                pool.submit(prepare_fold, preprocess, X.iloc[train], y.iloc[train], X.iloc[test])
+                for train, test in splits
+            ]
+            fold_data = [future.result() for future in futures]
+        with ProcessPoolExecutor(max_workers=max_workers(n_jobs), initializer=init_shared_folds, initargs=(fold_data,)) as pool:
+            refit_futures = {name: pool.submit(_fit_model, pipeline, X, y) for name, pipeline in pipelines.items()}
+            futures = [pool.submit(_fit_cached_fold, name, clone(clf), i) for name, clf in models.items() for i in range(len(splits))]
+            for future in futures:
+                name, i, *fold_result = future.result()
+                fold_results[name][i] = tuple(fold_result)
+            refits = {name: future.result() for name, future in refit_futures.items()}
+
+    results = dict()
+    for name in models:
+        _record_folds(name, fold_results[name])
+        roc, violin = _evaluate_folds(splits, y, y_bin, n_classes, fold_results[name], report)
+        results[name] = (roc, violin, refits[name])
+    return results
+
+@traced
+def cross_validate_models(preprocess, models: dict, X: pd.DataFrame, y: pd.DataFrame, folds: int=5, n_jobs: int=1) -> dict:
+    """Cross-validate several classifiers that share the same preprocessing pipeline.
+    The preprocessing and resampling steps are fitted once per fold, and the resulting fold
+    matrices are shared read-only by every candidate classifier. Each candidate is equivalent to
+    cross-validating the pipeline `preprocess` followed by a 'clf' step with `cross_validate`.
+    Args:
+        preprocess: Unfitted imblearn pipeline with the preprocessing and resampling steps.
+        models (dict): Unfitted classifiers by name.
+        X (pd.DataFrame): Features.
+        y (pd.DataFrame): Encoded target.
+        folds (int): Number of stratified folds.
+        n_jobs (int): Number of worker processes, 1 runs sequentially and -1 or None uses all the available cores.
+    Returns:
+        dict: The ROC figure, the violin figure and the refitted pipeline of each model, as returned by `cross_validate`.
+    """
+    return _cross_validate_models(preprocess, models, X, y, folds, n_jobs, 'full')
+
+@traced
+def cross_validate_models_compact(preprocess, models: dict, X: pd.DataFrame, y: pd.DataFrame, folds: int=5, n_jobs: int=1) -> dict:
+    """Cross-validate several classifiers as `cross_validate_models` without building any figure.
+    Returns:
+        dict: The mean ± std ROC curves, the fold metrics and the refitted pipeline of each model, as returned by `cross_validate_compact`.
+    """
+    return _cross_validate_models(preprocess, models, X, y, folds, n_jobs, 'compact')
+
+def save_cv_metrics(name: str, roc_curves: pd.DataFrame, fold_metrics: pd.DataFrame) -> None:
+    """Store the compact cross-validation results of a model in the metrics store, replacing its previous ones.
+    The store is a single long Parquet table with the fold metrics and the aggregated ROC curves of every model.
+    Args:
+        name (str): Name of the model.
+        roc_curves (pd.DataFrame): Mean ± std ROC curves per class returned by `cross_validate_compact`.
+        fold_metrics (pd.DataFrame): Fold metrics returned by `cross_validate_compact`.
+    Returns:
+        None
+    """
+    rows = pd.concat([
+        fold_metrics.rename(columns={'Fold': 'fold'}).melt(id_vars='fold', var_name='metric').assign(section='fold'),
+        roc_curves.melt(id_vars=['class', 'fpr'], var_name='metric').assign(section='roc')
+    ], ignore_index=True).assign(model=name, saved_at=pd.Timestamp.now(tz='UTC'))
+    rows = rows.astype({'fold': 'Int16', 'class': 'Int8', 'fpr': 'float32'})
+    store = load_cv_metrics()
+    if store is not None:
+        rows = pd.concat([store[store.model!=name], rows], ignore_index=True)
+    rows = rows.astype({'model': 'category', 'section': 'category', 'metric': 'category'})
+    write_artifact(rows, config.reporting['store'], config.path['model_metrics'], fmt='parquet', export_csv=False)
+
+def load_cv_metrics(name: str=None):
+    """Load the metrics store, or the compact cross-validation results of one model.
+    Args:
+        name (str): Name of the model, None returns the whole store.
+    Returns:
+        The store as a long table, None if it does not exist yet, or for a model its ROC curves and fold metrics.
+    """
+    file_path = os.path.join(config.path['model_metrics'], f"{config.reporting['store']}.parquet")
+    if not os.path.exists(file_path):
+        return None
+    store = read_artifact(config.reporting['store'], config.path['model_metrics'], fmt='parquet')
+    store = store.astype({'model': str, 'section': str, 'metric': str})
+    if name is None:
+        return store
+    rows = store[store.model==name]
+    if rows.empty:
+        raise KeyError(f'No cross-validation metrics stored for {name}')
+    folds = rows[rows.section=='fold'].pivot(index='fold', columns='metric', values='value')
+    fold_metrics = folds.reset_index().rename(columns={'fold': 'Fold'}).astype({'Fold': int})
+    fold_metrics = fold_metrics[['Fold'] + [col for col in rows[rows.section=='fold'].metric.unique()]]
+    roc_curves = rows[rows.section=='roc'].pivot(index=['class', 'fpr'], columns='metric', values='value').reset_index()
+    roc_curves = roc_curves.astype({'class': int})[['class', 'fpr', 'tpr_mean', 'tpr_std']]
+    return roc_curves, fold_metrics
+
+def write_cv_report(name: str, directory: str=None) -> tuple:
+    """Render the ROC and violin figures of a model from the metrics store and write them as HTML.
+    The figures reference a single plotly.js file shared by every report in the directory, instead of embedding it.
+    Args:
+        name (str): Name of the model.
+        directory (str): Output directory, by default `config.path['model_metrics']`.
+    Returns:
+        tuple: The paths of the ROC and violin HTML files.
+    """
+    directory = directory or config.path['model_metrics']
+    roc_curves, fold_metrics = load_cv_metrics(name)
+    paths = (os.path.join(directory, f'roc-{name}.html'), os.path.join(directory, f'violin-{name}.html'))
+    plot_roc_summary(roc_curves, fold_metrics).write_html(paths[0], include_plotlyjs='directory')
+    plot_metrics(fold_metrics).write_html(paths[1], include_plotlyjs='directory')
+    return paths
+
 # def get_training_inputs() -> dict:
 #     dataset = pd.read_csv(os.path.join('files', 'data', 'datasets', 'salinity_curated.csv'))
 #     encoder = OneHotEncoder(sparse_output=False, handle_unknown='ignore')
@@ -0,0 +1,265 @@
+import json, time, asyncio, traceback
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, parse_qs
+import pandas as pd, numpy as np
+
+import config
+from commons import load_spatial_index, lookup_class_hidr, salinity_crs
+from modeling.registry import load_model
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def load_state(model_name: str=None) -> dict:
+    """Load everything a prediction needs once: the pipeline, the label encoder, the spatial index and the CRS.
+    Args:
+        model_name (str): Name of the pipeline in the model registry, by default `config.server['model']`.
+    Returns:
+        dict: The server state, with its answer cache, pending queries and counters.
+    """
+    settings = config.server
+    load_spatial_index()
+    return {
+        'model_name': model_name or settings['model'], 'model': load_model(model_name or settings['model']),
+        'labels': [str(label) for label in load_model('LabelEncoder').classes_], 'crs': salinity_crs(),
+        'cache': OrderedDict(), 'pending': dict(), 'queue': asyncio.Queue(),
+        'stats': {
+            'started_at': time.time(), 'requests': 0, 'errors': 0, 'points': 0, 'cache_hits': 0, 'cache_misses': 0,
+            'batches': 0, 'batched_points': 0, 'max_batch': 0,
+            #finish time and latency in ms of the recent requests and batches
+            'latency': deque(maxlen=settings['latency_window']), 'batch_latency': deque(maxlen=settings['latency_window'])
+        }
+    }
+
+def predict_points(state: dict, xs: np.ndarray, ys: np.ndarray) -> list:
+    """Predict the salinity category of a batch of points with a single vectorized `predict_proba` call.
+    Points outside the hydrogeologic map are not predicted, their category and probabilities are None.
+    Args:
+        state (dict): Server state returned by `load_state`.
+        xs (np.ndarray): X coordinates in the salinity coordinate system.
+        ys (np.ndarray): Y coordinates in the salinity coordinate system.
+    Returns:
+        list: A prediction dict per point.
+    """
+    class_hidr = lookup_class_hidr(xs, ys, crs=state['crs'])
+    inside = pd.notna(class_hidr)
+    predictions = [
+        {'x': float(x), 'y': float(y), 'class_hidr': None, 'category': None, 'probabilities': None}
+        for x, y in zip(xs, ys)
+    ]
+    if inside.any():
+        X = pd.DataFrame({'X': xs[inside], 'Y': ys[inside], 'class_hidr': class_hidr[inside]})
+        probas_ = state['model'].predict_proba(X)
+        for i, row in zip(np.flatnonzero(inside), probas_):
+            predictions[i].update(
+                class_hidr=str(class_hidr[i]), category=state['labels'][int(row.argmax())],
+                probabilities={label: float(p) for label, p in zip(state['labels'], row)}
+            )
+    return predictions
+
+def _cache_key(x: float, y: float) -> tuple:
+    decimals = config.server['round_decimals']
+    return round(float(x), decimals), round(float(y), decimals)
+
+def _resolve(state: dict, keys: list, predictions: list=None, error: Exception=None) -> None:
+    """Answer the pending futures of a batch with its predictions or its error.
+    Futures that are already done, e.g. cancelled, are skipped."""
+    for i, key in enumerate(keys):
+        future = state['pending'].pop(key, None)
+        if future is None or future.done():
+            continue
+        if error is None:
+            future.set_result(predictions[i])
+        else:
+            future.set_exception(error)
+
+async def _batcher(state: dict) -> None:
+    """Coalesce the queued coordinates into micro-batches and answer their pending queries.
+    A batch is closed when it reaches `max_batch` points or `max_wait_ms` after its first point. While a
+    batch is predicted in a worker thread the next one keeps filling, so batches grow with the load.
+    A failed batch answers its queries with the error and the batcher goes on with the next one.
+    """
+    loop, queue, settings = asyncio.get_running_loop(), state['queue'], config.server
+    while True:
+        keys = [await queue.get()]
+        deadline = loop.time() + settings['max_wait_ms']/1000
+        while len(keys) < settings['max_batch']:
+            if not queue.empty():
+                keys.append(queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                keys.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            start = time.perf_counter()
+            xs, ys = np.array([key[0] for key in keys]), np.array([key[1] for key in keys])
+            predictions = await loop.run_in_executor(None, predict_points, state, xs, ys)
+            stats = state['stats']
+            stats['batches'] += 1
+            stats['batched_points'] += len(keys)
+            stats['max_batch'] = max(stats['max_batch'], len(keys))
+            stats['batch_latency'].append((time.time(), (time.perf_counter() - start)*1000))
+            for key, prediction in zip(keys, predictions):
+                state['cache'][key] = prediction
+            while len(state['cache']) > settings['cache_size']:
+                state['cache'].popitem(last=False)
+            _resolve(state, keys, predictions)
+        except Exception as error:
+            traceback.print_exc()
+            _resolve(state, keys, error=error)
+
+async def predict(state: dict, points: list) -> list:
+    """Answer a query of coordinates from the LRU cache or the micro-batches.
+    Coordinates are rounded to `config.server['round_decimals']` and predicted at the rounded position,
+    so concurrent and repeated queries of the same place share one prediction.
+    Args:
+        state (dict): Server state returned by `load_state`.
+        points (list): (x, y) pairs in the salinity coordinate system.
+    Returns:
+        list: A prediction dict per point.
+    """
+    loop, stats, futures = asyncio.get_running_loop(), state['stats'], []
+    for x, y in points:
+        key = _cache_key(x, y)
+        if key in state['cache']:
+            state['cache'].move_to_end(key)
+            stats['cache_hits'] += 1
+            futures.append(state['cache'][key])
+            continue
+        stats['cache_misses'] += 1
+        if key not in state['pending']:
+            state['pending'][key] = loop.create_future()
+            state['queue'].put_nowait(key)
+        futures.append(state['pending'][key])
+    stats['points'] += len(points)
+    #a cancelled query must not cancel the future that other queries of the same point are waiting on
+    return [future if isinstance(future, dict) else await asyncio.shield(future) for future in futures]
+
+def _percentiles(samples: deque) -> dict:
+    values = np.array([latency for _, latency in samples])
+    if not len(values):
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(values.max())}
+
+def server_stats(state: dict) -> dict:
+    """Latency and throughput counters of the server, with the latencies in ms over the recent requests."""
+    stats, now = state['stats'], time.time()
+    uptime = now - stats['started_at']
+    recent = [finished for finished, _ in stats['latency'] if finished > now - 60]
+    #under heavy load the latency window holds less than a minute of requests
+    span = now - recent[0] if len(recent)==stats['latency'].maxlen else min(60, uptime)
+    lookups = stats['cache_hits'] + stats['cache_misses']
+    return {
+        'model': state['model_name'], 'uptime_seconds': uptime,
+        'requests': stats['requests'], 'errors': stats['errors'], 'points': stats['points'],
+        'requests_per_second': stats['requests']/uptime if uptime else 0.0,
+        'requests_per_second_last_minute': len(recent)/span if span else 0.0,
+        'cache_hits': stats['cache_hits'], 'cache_misses': stats['cache_misses'],
+        'cache_hit_rate': stats['cache_hits']/lookups if lookups else None, 'cache_entries': len(state['cache']),
+        'batches': stats['batches'], 'max_batch_size': stats['max_batch'],
+        'mean_batch_size': stats['batched_points']/stats['batches'] if stats['batches'] else None,
+        'queued_points': state['queue'].qsize(),
+        'request_latency_ms': _percentiles(stats['latency']), 'batch_latency_ms': _percentiles(stats['batch_latency'])
+    }
+
+def _parse_points(method: str, query: dict, body: bytes) -> list:
+    """Read the queried points from the `x` and `y` query parameters or from a JSON body `{"points": [[x, y], ...]}`."""
+    if method=='GET':
+        points = [(float(query['x'][0]), float(query['y'][0]))]
+    else:
+        points = [(float(x), float(y)) for x, y in json.loads(body)['points']]
+    if not points or not all(np.isfinite(points).ravel()):
+        raise ValueError('points must be a non empty list of finite [x, y] pairs')
+    return points
+
+async def _respond(state: dict, method: str, target: str, body: bytes) -> tuple:
+    url = urlsplit(target)
+    if url.path=='/health':
+        return 200, {'status': 'ok', 'model': state['model_name']}
+    if url.path=='/stats':
+        return 200, server_stats(state)
+    if url.path!='/predict':
+        return 404, {'error': f'Unknown path {url.path}, use /predict, /stats or /health'}
+    if method not in ('GET', 'POST'):
+        return 405, {'error': 'Use GET /predict?x=..&y=.. or POST /predict with {"points": [[x, y], ...]}'}
+    try:
+        points = _parse_points(method, parse_qs(url.query), body)
+    except (KeyError, ValueError, TypeError) as error:
+        return 400, {'error': f'Invalid query: {error}'}
+    predictions = await predict(state, points)
+    return 200, predictions[0] if method=='GET' else {'predictions': predictions}
+
+async def _handle_connection(state: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Serve the HTTP/1.1 requests of a connection, keeping it open between requests unless the client closes it."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            start = time.perf_counter()
+            method, target, version = request_line.decode('latin-1').split()
+            headers = dict()
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            try:
+                status, payload = await _respond(state, method, target, body)
+            except Exception as error:
+                status, payload = 500, {'error': str(error)}
+            content = json.dumps(payload).encode()
+            keep_alive = headers.get('connection', '').lower()!='close' and version=='HTTP/1.1'
+            writer.write(
+                f'HTTP/1.1 {status} {_reasons[status]}\r\nContent-Type: application/json\r\n'
+                f'Content-Length: {len(content)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + content
+            )
+            await writer.drain()
+            stats = state['stats']
+            stats['requests'] += 1
+            stats['errors'] += status>=400
+            stats['latency'].append((time.time(), (time.perf_counter() - start)*1000))
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(model_name: str=None, host: str=None, port: int=None) -> None:
+    """Run the prediction server until it is cancelled.
+    The pipeline, the label encoder and the hydrogeologic spatial index are loaded once at start up.
+    Endpoints:
+    - `GET /predict?x=..&y=..` predicts a point, `POST /predict` with `{"points": [[x, y], ...]}` predicts several.
+    - `GET /stats` returns the latency, throughput, batching and cache counters.
+    - `GET /health` returns the served model.
+    Args:
+        model_name (str): Name of the pipeline in the model registry, by default `config.server['model']`.
+        host (str): Interface to listen on, by default `config.server['host']`.
+        port (int): Port to listen on, by default `config.server['port']`.
+    Returns:
+        None
+    """
+    state = load_state(model_name)
+    batcher = asyncio.create_task(_batcher(state))
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_connection(state, reader, writer),
+        host or config.server['host'], port or config.server['port']
+    )
+    print(f"Serving {state['model_name']} predictions on http://{host or config.server['host']}:{port or config.server['port']}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher.cancel()
+
+def run_server(model_name: str=None, host: str=None, port: int=None) -> None:
+    """Run the prediction server in the current process until it is interrupted, see `serve`."""
+    try:
+        asyncio.run(serve(model_name, host, port))
+    except KeyboardInterrupt:
+        pass
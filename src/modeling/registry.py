@@ -0,0 +1,92 @@
+import os, json, pickle
+from datetime import datetime, timezone
+from collections import OrderedDict
+from threading import Lock
+import joblib
+
+import config
+from config import models_args
+from commons.stage_cache import fingerprint
+
+#loaded models shared by every consumer in the process, least recently used first
+_loaded = OrderedDict()
+_lock = Lock()
+
+
+def registry_file() -> str:
+    """Path of the registry index with the metadata of the stored models."""
+    return os.path.join(config.path['models'], 'registry.json')
+
+def load_registry() -> dict:
+    """Load the metadata of the stored models by name.
+    Args:
+        None
+    Returns:
+        dict: The registry entries by model name.
+    """
+    if not os.path.exists(registry_file()):
+        return dict()
+    with open(registry_file()) as f:
+        return json.load(f)
+
+def save_model(model, name: str, X=None, y=None, params: dict=None, metrics: dict=None) -> dict:
+    """Store a fitted model and its metadata in the registry.
+    The model is dumped uncompressed with joblib, so its numpy arrays (support vectors, KNN training
+    data, tree arrays) can be memory-mapped when the model is loaded.
+    Args:
+        model: The fitted model, pipeline or encoder.
+        name (str): Name of the model in the registry.
+        X: Features used to fit the model, to record their hash.
+        y: Target used to fit the model, to record its hash.
+        params (dict): Parameters of the model, by default the ones in `config.models_args` for the name.
+        metrics (dict): Evaluation metrics of the model.
+    Returns:
+        dict: The registry entry of the model.
+    """
+    entry = {
+        'file': f'{name}.joblib',
+        'saved_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'training_data': fingerprint(X, y) if X is not None else None,
+        'params': params if params is not None else getattr(models_args, name, None),
+        'metrics': metrics
+    }
+    joblib.dump(model, os.path.join(config.path['models'], entry['file']))
+    with _lock:
+        registry = load_registry()
+        registry[name] = entry
+        with open(f'{registry_file()}.tmp', 'w') as f:
+            json.dump(registry, f, indent=2, default=str)
+        os.replace(f'{registry_file()}.tmp', registry_file())
+        _loaded.pop(name, None)
+    return entry
+
+def load_model(name: str):
+    """Load a model from the registry, sharing it from the in-process cache.
+    Models stored with `save_model` are loaded with their numpy arrays memory-mapped copy-on-write,
+    so processes that load the same model share its pages. Models only available as the legacy
+    `<name>.pkl` files are unpickled. The least recently used models are evicted beyond
+    `config.registry['cache_size']`.
+    Args:
+        name (str): Name of the model in the registry.
+    Returns:
+        The loaded model.
+    """
+    with _lock:
+        if name in _loaded:
+            _loaded.move_to_end(name)
+            return _loaded[name]
+        entry = load_registry().get(name)
+        if entry is not None:
+            #copy-on-write maps keep the pages shared between processes and stay writable for libsvm
+            model = joblib.load(os.path.join(config.path['models'], entry['file']), mmap_mode='c')
+        else:
+            with open(os.path.join(config.path['models'], f'{name}.pkl'), 'rb') as f:
+                model = pickle.load(f)
+        _loaded[name] = model
+        while len(_loaded)>config.registry['cache_size']:
+            _loaded.popitem(last=False)
+        return model
+
+def model_metadata(name: str) -> dict:
+    """Get the registry entry of a model, None for models that are not registered."""
+    return load_registry().get(name)
@@ -0,0 +1,261 @@
+import os, json, glob, time, math, runpy, importlib, warnings, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd, numpy as np
+from sklearn.model_selection import StratifiedKFold, ParameterGrid
+from sklearn.metrics import f1_score, balanced_accuracy_score, roc_auc_score
+from sklearn.exceptions import FitFailedWarning
+
+import config
+from config import search_spaces, models_args
+from commons import fingerprint
+from modeling.cross_validation import max_workers, prepare_fold, init_shared_folds, shared_fold
+
+_scorers = {
+    'f1_macro': lambda y_true, probas, preds: f1_score(y_true, preds, average='macro'),
+    'balanced_accuracy': lambda y_true, probas, preds: balanced_accuracy_score(y_true, preds),
+    'roc_auc_ovr_weighted': lambda y_true, probas, preds: roc_auc_score(y_true, probas, average='weighted', multi_class='ovr')
+}
+
+#training row order of each fold, its prefixes are the nested subsamples of the successive rungs
+_shared_orders = []
+
+
+def make_estimator(estimator: str, params: dict):
+    """Instantiate a classifier from the dotted path of its class and its arguments."""
+    module, name = estimator.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)(**params)
+
+def canonical_params(estimator: str, params: dict) -> dict:
+    """Drop the arguments a combination ignores and rename equivalent values, so that combinations
+    that train the same model become identical and are evaluated once.
+    Args:
+        estimator (str): Dotted path of the classifier class.
+        params (dict): Searched arguments of the combination.
+    Returns:
+        dict: The canonical arguments.
+    """
+    params, name = dict(params), estimator.rsplit('.', 1)[1]
+    if name == 'LogisticRegression':
+        if params.get('penalty', 'l2') != 'elasticnet':
+            params.pop('l1_ratio', None)
+        elif params.get('l1_ratio') in (0, 1):
+            #elasticnet at the ends of l1_ratio is the l2 or l1 penalty
+            params['penalty'] = 'l1' if params.pop('l1_ratio') == 1 else 'l2'
+    if name == 'SVC':
+        kernel = params.get('kernel', 'rbf')
+        if kernel == 'linear':
+            params.pop('gamma', None)
+        if kernel != 'poly':
+            params.pop('degree', None)
+        if kernel not in ('poly', 'sigmoid'):
+            params.pop('coef0', None)
+    if name in ('DecisionTreeClassifier', 'RandomForestClassifier', 'ExtraTreesClassifier'):
+        if params.get('criterion') == 'log_loss':
+            params['criterion'] = 'entropy'
+    if name == 'MLPClassifier':
+        if isinstance(params.get('hidden_layer_sizes'), int):
+            params['hidden_layer_sizes'] = (params['hidden_layer_sizes'],)
+        if params.get('solver', 'adam') != 'sgd':
+            for key in ('momentum', 'nesterovs_momentum', 'learning_rate'):
+                params.pop(key, None)
+    return params
+
+def _params_key(params: dict) -> str:
+    return repr(sorted(params.items()))
+
+def sample_candidates(spec: dict, n_candidates: int, random_state: int) -> list:
+    """Sample valid combinations of a search space.
+    Every combination of the grid is reduced to its canonical arguments and duplicates are
+    dropped before sampling, so the budget is only spent on distinct models.
+    Args:
+        spec (dict): Search space, with the 'estimator' path and the searched 'space' values.
+        n_candidates (int): Maximum number of combinations sampled.
+        random_state (int): Seed of the sample.
+    Returns:
+        list: The sampled arguments of each candidate.
+    """
+    unique = dict()
+    for params in ParameterGrid(spec['space']):
+        params = canonical_params(spec['estimator'], params)
+        unique.setdefault(_params_key(params), params)
+    candidates = list(unique.values())
+    if len(candidates) > n_candidates:
+        rng = np.random.default_rng(random_state)
+        candidates = [candidates[i] for i in sorted(rng.choice(len(candidates), n_candidates, replace=False))]
+    return candidates
+
+def halving_schedule(n_candidates: int, eta: int, min_fraction: float) -> list:
+    """Number of candidates and fraction of the training folds of each rung of successive halving.
+    Each rung keeps the best 1/eta of the candidates and trains them on eta times more rows, the
+    last rung uses the full training folds.
+    """
+    sizes = [n_candidates]
+    while sizes[-1] > eta:
+        sizes.append(math.ceil(sizes[-1]/eta))
+    last = len(sizes) - 1
+    return [(size, max(min_fraction, float(eta)**(rung - last))) for rung, size in enumerate(sizes)]
+
+def _stratified_order(y: np.ndarray, random_state: int) -> np.ndarray:
+    """Shuffle the rows so that every prefix keeps the class proportions of y."""
+    rng = np.random.default_rng(random_state)
+    position = np.empty(len(y))
+    for label in np.unique(y):
+        rows = rng.permutation(np.flatnonzero(y == label))
+        position[rows] = (np.arange(len(rows)) + rng.random())/len(rows)
+    return np.argsort(position, kind='stable')
+
+def _init_search(folds: list, orders: list) -> None:
+    init_shared_folds(folds)
+    _shared_orders[:] = orders
+
+def _fit_candidate_fold(key: str, estimator: str, params: dict, i: int, fraction: float, proba: bool) -> tuple:
+    X_train, y_train, X_test = shared_fold(i)
+    order = _shared_orders[i]
+    rows = order[:max(1, math.ceil(fraction*len(order)))]
+    model = make_estimator(estimator, params)
+    try:
+        model.fit(X_train.iloc[rows] if hasattr(X_train, 'iloc') else X_train[rows], np.asarray(y_train)[rows])
+        return key, i, model.predict_proba(X_test) if proba else None, model.predict(X_test), None
+    except Exception:
+        #failed fits score nan and are ranked last, as GridSearchCV does with error_score=nan
+        return key, i, None, None, traceback.format_exc()
+
+def _checkpoint_file(name: str, run_key: str) -> str:
+    return os.path.join(config.path['search'], f'{name}-{run_key[:16]}.jsonl')
+
+def _load_checkpoint(name: str, run_key: str) -> dict:
+    """Scores already computed by an interrupted sweep with the same data and settings, by rung and candidate."""
+    file_path = _checkpoint_file(name, run_key)
+    for stale in glob.glob(os.path.join(config.path['search'], f'{name}-*.jsonl')):
+        if stale != file_path:
+            os.remove(stale)
+    scores = dict()
+    if os.path.exists(file_path):
+        with open(file_path) as f:
+            for line in f:
+                #a line cut by the interruption is evaluated again
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                scores[(record['rung'], record['key'])] = record['score']
+    return scores
+
+def _run_rung(pool, name: str, spec: dict, candidates: dict, rung: int, fraction: float, scores: dict,
+              tests: list, y: np.ndarray, scoring: str) -> None:
+    """Evaluate the candidates of a rung that are not in the checkpoint, appending each score when its folds finish."""
+    pending = [key for key in candidates if (rung, key) not in scores]
+    proba = scoring == 'roc_auc_ovr_weighted'
+    tasks = [(key, spec['estimator'], spec['fixed'] | candidates[key], i, fraction, proba)
+             for key in pending for i in range(len(tests))]
+    results = iter(_fit_candidate_fold(*task) for task in tasks) if pool is None else \
+        as_completed([pool.submit(_fit_candidate_fold, *task) for task in tasks])
+    folds = {key: dict() for key in pending}
+    with open(_checkpoint_file(name, spec['run_key']), 'a') as f:
+        for result in results:
+            key, i, probas, preds, error = result if pool is None else result.result()
+            if error is not None:
+                warnings.warn(f'{name} candidate {candidates[key]} failed on fold {i}, its score is nan:\n{error}', FitFailedWarning)
+            folds[key][i] = np.nan if preds is None else _scorers[scoring](y[tests[i]], probas, preds)
+            if len(folds[key]) == len(tests):
+                scores[(rung, key)] = float(np.mean(list(folds[key].values())))
+                f.write(json.dumps({'rung': rung, 'key': key, 'params': candidates[key], 'score': scores[(rung, key)]},
+                                   default=str) + '\n')
+                f.flush()
+
+def _search_model(pool, name: str, spec: dict, tests: list, y: np.ndarray, settings: dict) -> dict:
+    """Successive halving over the sampled candidates of a model, resuming from its checkpoint."""
+    candidates = {_params_key(params): params for params in
+                  sample_candidates(spec, settings['n_candidates'], settings['random_state'])}
+    scores = _load_checkpoint(name, spec['run_key'])
+    schedule = halving_schedule(len(candidates), settings['eta'], settings['min_fraction'])
+    start, alive = time.monotonic(), candidates
+    for rung, (size, fraction) in enumerate(schedule):
+        if rung and settings['max_seconds'] is not None and time.monotonic() - start > settings['max_seconds']:
+            break
+        _run_rung(pool, name, spec, alive, rung, fraction, scores, tests, y, settings['scoring'])
+        #nan scores are ranked last
+        ranking = sorted(alive, key=lambda key: -np.nan_to_num(scores[(rung, key)], nan=-np.inf))
+        best, best_rung, best_fraction = ranking[0], rung, fraction
+        if rung + 1 < len(schedule):
+            alive = {key: candidates[key] for key in ranking[:schedule[rung + 1][0]]}
+    params = spec['fixed'] | candidates[best]
+    return {
+        'params': params, 'score': scores[(best_rung, best)], 'rung': best_rung, 'fraction': best_fraction,
+        'n_candidates': len(candidates), 'evaluations': sum(1 for rung, _ in scores if rung <= best_rung),
+        'model': make_estimator(spec['estimator'], params)
+    }
+
+def search_models(preprocess, X: pd.DataFrame, y: pd.Series, names: list=None, write_args: bool=True, **settings) -> dict:
+    """Search the hyperparameters of the classifiers with budgeted successive halving.
+    For each model of `config.search_spaces`, distinct valid combinations are sampled and
+    evaluated on growing stratified subsamples of the training folds, keeping the best 1/eta at
+    each rung until the survivors are trained on the full folds or the time budget runs out. The
+    preprocessing and resampling steps are fitted once per fold and the fold matrices are shared
+    by every candidate, which are fitted in parallel worker processes. Each evaluated candidate is
+    appended to a checkpoint in `config.path['search']`, so an interrupted sweep resumes where it
+    stopped while the data and the settings are unchanged.
+    Args:
+        preprocess: Unfitted imblearn pipeline with the preprocessing and resampling steps.
+        X (pd.DataFrame): Features.
+        y (pd.Series): Encoded target.
+        names (list): Models of `config.search_spaces` to search, by default all of them.
+        write_args (bool): Whether to write the best arguments of each model to `config/models_args.py`. Models
+            whose candidates all failed to fit keep their arguments, failed fits are reported as `FitFailedWarning`.
+        **settings: Overrides of `config.search`, e.g. n_candidates, eta, folds, max_seconds or n_jobs.
+    Returns:
+        dict: For each model, the best 'params', their mean fold 'score', the 'rung' and training
+            'fraction' where it was measured, the number of candidates and evaluations, and the unfitted 'model'.
+    """
+    settings = config.search | settings
+    spaces = {name: spec for name, spec in vars(search_spaces).items() if isinstance(spec, dict) and 'estimator' in spec}
+    names = names or list(spaces)
+    y = pd.Series(np.asarray(y))
+    cv = StratifiedKFold(n_splits=settings['folds'], shuffle=True, random_state=settings['random_state'])
+    splits = list(cv.split(X, y))
+    tests = [test for _, test in splits]
+    data_key = fingerprint(X, y, repr(preprocess), {key: settings[key] for key in settings if key not in ('max_seconds', 'n_jobs')})
+    os.makedirs(config.path['search'], exist_ok=True)
+
+    if settings['n_jobs'] == 1:
+        fold_data = [prepare_fold(preprocess, X.iloc[train], y.iloc[train], X.iloc[test]) for train, test in splits]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers(settings['n_jobs'])) as pool:
+            futures = [pool.submit(prepare_fold, preprocess, X.iloc[train], y.iloc[train], X.iloc[test]) for train, test in splits]
+            fold_data = [future.result() for future in futures]
+    orders = [_stratified_order(np.asarray(y_train), settings['random_state']) for _, y_train, _ in fold_data]
+
+    results = dict()
+    if settings['n_jobs'] == 1:
+        _init_search(fold_data, orders)
+        for name in names:
+            spec = spaces[name] | {'run_key': fingerprint(data_key, spaces[name])}
+            results[name] = _search_model(None, name, spec, tests, y.to_numpy(), settings)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers(settings['n_jobs']), initializer=_init_search,
+                                 initargs=(fold_data, orders)) as pool:
+            for name in names:
+                spec = spaces[name] | {'run_key': fingerprint(data_key, spaces[name])}
+                results[name] = _search_model(pool, name, spec, tests, y.to_numpy(), settings)
+    failed = [name for name, result in results.items() if np.isnan(result['score'])]
+    if failed:
+        warnings.warn(f'Every candidate of {failed} failed, their arguments are not updated', FitFailedWarning)
+    if write_args:
+        write_models_args({name: result['params'] for name, result in results.items() if name not in failed})
+    return results
+
+def write_models_args(args: dict, file_path: str=None) -> None:
+    """Write the arguments of the models to `config/models_args.py`, keeping the models that are not updated.
+    Args:
+        args (dict): Arguments of each model by name.
+        file_path (str): Path of the module, by default the one of `config.models_args`.
+    Returns:
+        None
+    """
+    file_path = file_path or models_args.__file__
+    current = {name: value for name, value in runpy.run_path(file_path).items() if not name.startswith('__')}
+    content = '\n'.join([f'{name} = {str(params)}' for name, params in (current | args).items()])
+    with open(f'{file_path}.tmp', mode='w') as f:
+        f.write(content)
+    os.replace(f'{file_path}.tmp', file_path)
+    importlib.reload(models_args)
@@ -0,0 +1,112 @@
+import json, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pandas as pd
+import pytest
+
+import config
+from data_processing import ingestion
+from data_processing.cleaning import clean_salinity
+from data_processing.ingestion import api_field_name, ingest_salinity
+
+N_RECORDS = 23
+
+
+def soda_records(n: int) -> list:
+    """Records as the SODA API returns them: every value as text, under the portal field names."""
+    records = []
+    for i in range(n):
+        record = {api_field_name(col): str(i) for col in config.salinity_data_dictionary}
+        record.update({'tipo_de_ca': 'Pozo', 'uso_del_su': 'Ganaderia', 'x': str(1_150_000 + i), 'y': str(1_700_000 + i)})
+        records.append(record)
+    return records
+
+
+class SodaStandIn(BaseHTTPRequestHandler):
+    """Local stand-in of a Socrata resource endpoint with `$select=count(*)`, `$limit`/`$offset` paging,
+    ETag validators and pages that can be made to fail."""
+    records, etag, failing_offsets, log = [], '"v1"', set(), []
+
+    def do_GET(self):
+        query = {key: values[0] for key, values in parse_qs(urlsplit(self.path).query).items()}
+        self.log.append(query)
+        if '$select' in query:
+            if self.headers.get('If-None-Match')==self.etag:
+                return self._send(304, None)
+            return self._send(200, [{'count': str(len(self.records))}])
+        offset, limit = int(query['$offset']), int(query['$limit'])
+        if offset in self.failing_offsets:
+            return self._send(500, {'error': 'unavailable'})
+        self._send(200, self.records[offset:offset + limit])
+
+    def _send(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def soda_url(tmp_path, monkeypatch):
+    """URL of a local SODA stand-in, with the pipeline working in a scratch directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(config.ingestion, 'page_size', 5)
+    monkeypatch.setitem(config.ingestion, 'retries', 1)
+    monkeypatch.setattr(ingestion.time, 'sleep', lambda seconds: None)
+    SodaStandIn.records, SodaStandIn.failing_offsets, SodaStandIn.log = soda_records(N_RECORDS), set(), []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SodaStandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/resource/salinity.json'
+    server.shutdown()
+    server.server_close()
+
+def page_requests() -> list:
+    return [query for query in SodaStandIn.log if '$offset' in query]
+
+def test_api_field_name():
+    assert api_field_name('Método_de') == 'metodo_de'
+    assert api_field_name('Prof_Húme') == 'prof_hume'
+    assert api_field_name('Condición') == 'condicion'
+    assert api_field_name('sigsonia__') == 'sigsonia'
+
+def test_ingestion_maps_every_column_back(soda_url):
+    salinity = ingest_salinity(soda_url)
+    assert len(salinity) == N_RECORDS
+    assert set(salinity.columns) == set(config.salinity_data_dictionary)
+    assert salinity['OBJECTID'].astype(int).tolist() == list(range(N_RECORDS))
+    assert len(page_requests()) == 5
+    #the accented columns are found again, so the cleaning plan can drop and parse them
+    cleaned = clean_salinity(salinity)
+    assert 'Método_de' not in cleaned.columns and 'SAL' in cleaned.columns
+
+def test_unchanged_source_is_not_downloaded_again(soda_url):
+    first = ingest_salinity(soda_url)
+    SodaStandIn.log.clear()
+    second = ingest_salinity(soda_url)
+    assert page_requests() == []
+    pd.testing.assert_frame_equal(first, second)
+
+def test_interrupted_download_resumes(soda_url):
+    SodaStandIn.failing_offsets = {10}
+    with pytest.raises(Exception):
+        ingest_salinity(soda_url)
+    SodaStandIn.failing_offsets, SodaStandIn.log = set(), []
+    salinity = ingest_salinity(soda_url)
+    assert len(salinity) == N_RECORDS
+    #only the page that failed is fetched again
+    assert [int(query['$offset']) for query in page_requests()] == [10]
+
+def test_changed_source_starts_over(soda_url):
+    ingest_salinity(soda_url)
+    SodaStandIn.records, SodaStandIn.etag, SodaStandIn.log = soda_records(N_RECORDS + 4), '"v2"', []
+    salinity = ingest_salinity(soda_url)
+    assert len(salinity) == N_RECORDS + 4
+    assert len(page_requests()) == 6